@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+from threading import Thread
+
+import cv2
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'tracking'))
+
+from capture import CaptureCoordinator
+
+FRAMES = 10
+
+# long enough to cover a full video, but not to hang the suite
+TIMEOUT = 10
+
+
+def write_video(path, frames, size = (64, 48)):
+    width, height = size
+
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'MJPG'), 30, size)
+    for i in range(frames):
+        frame = np.full((height, width, 3), i * 16 % 256, np.uint8)
+        writer.write(frame)
+
+    writer.release()
+
+
+def read_all(channel, results):
+    while True:
+        ret, frame = channel.read()
+        if not ret:
+            break
+
+        results.append(frame)
+
+
+class CaptureCoordinatorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+        self.videos = []
+        for i in range(2):
+            path = os.path.join(self.directory, 'camera%d.avi' % i)
+            write_video(path, FRAMES)
+            self.videos.append(path)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def consume(self, channel):
+        results = []
+
+        thread = Thread(target = read_all, args = (channel, results))
+        thread.daemon = True
+        thread.start()
+
+        return thread, results
+
+    def test_framesets(self):
+        coordinator = CaptureCoordinator(self.videos, drop = False, framesets = True)
+        coordinator.start()
+
+        sets = []
+        while True:
+            frameset = coordinator.get()
+            if frameset is None:
+                break
+
+            sets.append(frameset)
+
+        self.assertEqual(len(sets), FRAMES)
+        self.assertEqual([s.sequence for s in sets], range(FRAMES))
+
+        # the decoding pool is shut down with the capture thread
+        coordinator.join(TIMEOUT)
+        self.assertFalse(any(worker.is_alive() for worker in coordinator.pool._pool))
+
+        for frameset in sets:
+            self.assertEqual(len(frameset.frames), 2)
+            self.assertGreaterEqual(frameset.skew, 0.0)
+
+    def test_channels(self):
+        coordinator = CaptureCoordinator(self.videos, drop = False)
+        consumers = [self.consume(channel) for channel in coordinator.channels]
+        coordinator.start()
+
+        for thread, results in consumers:
+            thread.join(TIMEOUT)
+            self.assertFalse(thread.is_alive())
+            self.assertEqual(len(results), FRAMES)
+
+    def test_release_one_channel(self):
+        coordinator = CaptureCoordinator(self.videos, queue_size = 1, drop = False)
+
+        # the first channel's consumer exits without reading, while capture waits for every consumer
+        coordinator.channels[0].release()
+
+        thread, results = self.consume(coordinator.channels[1])
+        coordinator.start()
+
+        thread.join(TIMEOUT)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(len(results), FRAMES)
+
+    def test_release_blocked_channel(self):
+        coordinator = CaptureCoordinator(self.videos, queue_size = 1, drop = False)
+        first, second = coordinator.channels
+
+        coordinator.start()
+
+        # capture blocks on the full first channel until it is released
+        ret, frame = first.read()
+        self.assertTrue(ret)
+
+        thread, results = self.consume(second)
+        first.release()
+
+        thread.join(TIMEOUT)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(len(results), FRAMES)
+
+        coordinator.join(TIMEOUT)
+        self.assertFalse(coordinator.is_alive())
+
+    def test_release_immediately(self):
+        coordinator = CaptureCoordinator(self.videos, queue_size = 1, drop = False)
+        coordinator.start()
+
+        for channel in coordinator.channels:
+            channel.release()
+
+        coordinator.join(TIMEOUT)
+        self.assertFalse(coordinator.is_alive())
+        self.assertLess(coordinator.sequence, FRAMES)
+
+    def test_release_all_channels(self):
+        coordinator = CaptureCoordinator(self.videos, queue_size = 1, drop = False)
+        coordinator.start()
+
+        for channel in coordinator.channels:
+            ret, frame = channel.read()
+            self.assertTrue(ret)
+
+        for channel in coordinator.channels:
+            channel.release()
+
+        coordinator.join(TIMEOUT)
+        self.assertFalse(coordinator.is_alive())
+        self.assertLess(coordinator.sequence, FRAMES)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'tracking'))
+
+from cluster import Cluster
+from point import Point
+from publish import Publisher, Subscriber
+from schema import encode, decode
+from vision import Circle
+
+TIMEOUT = 10
+
+
+def make_points(count):
+    return [Point(Circle(0, None, (40, 40, 200), 10.0 + i, 20.0 + i, 4, 0.9)) for i in range(count)]
+
+
+def wait_for(condition):
+    deadline = time.time() + TIMEOUT
+    while not condition():
+        if time.time() > deadline:
+            raise AssertionError("timed out")
+
+        time.sleep(0.01)
+
+
+class PublishTest(unittest.TestCase):
+
+    def setUp(self):
+        self.points = make_points(4)
+        self.clusters = [Cluster(self.points[:3])]
+
+        self.directory = tempfile.mkdtemp()
+        self.publisher = None
+        self.subscriber = None
+
+    def tearDown(self):
+        if self.subscriber is not None:
+            self.subscriber.close()
+
+        if self.publisher is not None:
+            self.publisher.stop()
+
+        shutil.rmtree(self.directory)
+
+    def start(self, **transports):
+        self.publisher = Publisher(**transports)
+        self.publisher.start()
+
+        return self.publisher
+
+    def connect(self, **transport):
+        self.subscriber = Subscriber(**transport)
+        self.subscriber.sock.settimeout(TIMEOUT)
+
+        # stream clients are accepted asynchronously, and only receive messages published after that
+        if 'udp' not in transport:
+            wait_for(lambda: self.publisher.clients)
+
+        return self.subscriber
+
+    def check_message(self, message, sequence, frame_count):
+        self.assertEqual(message.camera, 1)
+        self.assertEqual(message.sequence, sequence)
+        self.assertEqual(message.frame_count, frame_count)
+        self.assertEqual(message.timestamp, 0.5 * frame_count)
+
+        self.assertEqual(message.points['index'].tolist(), [p.index for p in self.points])
+        self.assertEqual(message.points['x'].tolist(), [p.x_window_mean for p in self.points])
+        self.assertEqual(message.points['y'].tolist(), [p.y_window_mean for p in self.points])
+
+        cluster = self.clusters[0].index
+        self.assertEqual(message.points['cluster'].tolist(), [cluster, cluster, cluster, -1])
+
+        self.assertEqual(message.clusters['index'].tolist(), [cluster])
+        self.assertEqual(message.clusters['size'].tolist(), [3])
+        self.assertTrue(np.isnan(message.clusters['rvec']).all())
+
+    def round_trip(self, subscriber):
+        for frame_count in range(3):
+            self.publisher.publish(1, frame_count, 0.5 * frame_count, self.points, self.clusters)
+
+        for sequence in range(3):
+            self.check_message(subscriber.receive(), sequence, sequence)
+
+    def test_encode_decode(self):
+        data = encode(1, 7, 2, 1.0, self.points, self.clusters)
+        self.check_message(decode(data), 7, 2)
+
+    def test_udp(self):
+        subscriber = Subscriber(udp = ('127.0.0.1', 0))
+        subscriber.sock.settimeout(TIMEOUT)
+        self.subscriber = subscriber
+
+        self.start(udp = [subscriber.sock.getsockname()])
+        self.round_trip(subscriber)
+
+    def test_tcp(self):
+        publisher = self.start(tcp = ('127.0.0.1', 0))
+        self.round_trip(self.connect(tcp = publisher.addresses[0]))
+
+    def test_unix(self):
+        path = os.path.join(self.directory, 'tracking.sock')
+
+        self.start(unix = path)
+        self.round_trip(self.connect(unix = path))
+
+    def test_slow_client(self):
+        publisher = Publisher(tcp = ('127.0.0.1', 0), queue_size = 2)
+        publisher.start()
+        self.publisher = publisher
+
+        subscriber = self.connect(tcp = publisher.addresses[0])
+
+        # large messages fill the socket buffers while the subscriber isn't reading, so the client's queue overflows
+        points = make_points(2000)
+        count = 0
+        while not publisher.clients[0].dropped:
+            publisher.publish(1, count, 0.0, points, [])
+            count += 1
+
+            self.assertLess(count, 10000)
+
+        # the subscriber sees whole messages in order, with gaps where messages were dropped
+        sequences = []
+        while not sequences or sequences[-1] < count - 1:
+            message = subscriber.receive()
+            self.assertEqual(len(message.points), len(points))
+
+            sequences.append(message.sequence)
+
+        self.assertEqual(sequences, sorted(sequences))
+        self.assertEqual(count - len(sequences), publisher.clients[0].dropped)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+"""
+Batched vision processing for multi-camera rigs.
+
+Rather than having each :class:`tracking.main.TrackingThread` run the same blur, erosion and dark-mask sequence
+separately, a :class:`BatchedTracker` gathers one frame from every camera into a single stacked buffer and runs these
+shared stages as one operation. Edge detection, contour analysis and tracking state remain per camera.
+"""
+
+import cv2
+import numpy as np
+
+from threading import Thread
+
+from latency import FrameTrace, monotonic, read_frame
+from vision import FrameBuffers, preprocess, find_search_area, find_circles
+
+#: Rows of padding placed above and below each frame in the stacked buffer. Padding is a mirror image of the frame
+#: edge, which (for the symmetric blur and erosion kernels) reproduces exactly what the stages would compute on the
+#: frame alone, provided it covers their combined reach (2 + 15 rows).
+STACK_PADDING = 20
+
+
+class BatchedTracker(Thread):
+    """
+    Drives a set of (unstarted) :class:`tracking.main.TrackingThread` instances with batched vision stages. Each
+    thread's ``capture`` is read in turn, and results are still delivered through each thread's ``frames`` queue, so
+    consumers are unchanged. All cameras must share the same resolution.
+    """
+
+    def __init__(self, threads, coordinator = None):
+        """
+        :param threads: a list of TrackingThread instances; these should not be started
+        :param coordinator: an optional :class:`tracking.capture.CaptureCoordinator` delivering frame sets, used
+                            instead of reading each thread's ``capture`` in turn
+        """
+        super(BatchedTracker, self).__init__()
+
+        self.threads = threads
+        self.coordinator = coordinator
+        self.buffers = FrameBuffers()
+        self.stacked = None
+
+        self.running = False
+
+    def stack(self, frames):
+        """
+        Copies the given frames into the stacked buffer, with mirrored padding between them.
+
+        :param frames: a list of equally sized BGR frames
+        :return: the stacked buffer
+        """
+        height, width, channels = frames[0].shape
+        pitch = height + 2 * STACK_PADDING
+
+        shape = (pitch * len(frames), width, channels)
+        if self.stacked is None or self.stacked.shape != shape:
+            self.stacked = np.empty(shape, frames[0].dtype)
+
+        for i, frame in enumerate(frames):
+            top = i * pitch
+            body = top + STACK_PADDING
+
+            self.stacked[body:body + height] = frame
+
+            # reflect (without repeating the edge row) into the padding on either side
+            self.stacked[top:body] = frame[STACK_PADDING:0:-1]
+            self.stacked[body + height:top + pitch] = frame[-2:-STACK_PADDING - 2:-1]
+
+        return self.stacked
+
+    def process(self, frames, capture_times = None):
+        """
+        Processes one frame from each camera, and hands the results to each thread's :meth:`track` method.
+
+        :param frames: a list of BGR frames, in the same order as ``self.threads``
+        :param capture_times: a list of monotonic capture times, one per frame; by default now
+        """
+        if capture_times is None:
+            capture_times = [monotonic()] * len(frames)
+
+        traces = [FrameTrace(thread.name, thread.frame_count, capture_time)
+                  for thread, capture_time in zip(self.threads, capture_times)]
+
+        for trace in traces:
+            trace.mark('start')
+
+        stacked = self.stack(frames)
+        height = frames[0].shape[0]
+        pitch = height + 2 * STACK_PADDING
+
+        blurred = preprocess(stacked, self.buffers)
+        search_area = find_search_area(blurred, self.buffers)
+
+        for trace in traces:
+            trace.mark('batch')
+
+        for i, thread in enumerate(self.threads):
+            body = i * pitch + STACK_PADDING
+            rows = slice(body, body + height)
+
+            frame = blurred[rows]
+            edges = cv2.Canny(search_area[rows], 100, 50, edges = self.buffers.edges[rows])
+            circles = find_circles(frame, thread.frame_count, edges, self.buffers.tile(i))
+            traces[i].mark('detect')
+
+            thread.track(frame, circles, traces[i])
+
+    def run(self):
+        self.running = True
+
+        while self.running:
+            if self.coordinator is not None:
+                frameset = self.coordinator.get()
+                if frameset is None:
+                    print "reached end of stream"
+                    break
+
+                self.process(frameset.frames, frameset.timestamps)
+                continue
+
+            frames = []
+            capture_times = []
+            for thread in self.threads:
+                frame, capture_time = read_frame(thread.capture)
+                frames.append(frame)
+                capture_times.append(capture_time)
+
+            if any(frame is None for frame in frames):
+                print "reached end of stream"
+                break
+
+            self.process(frames, capture_times)
+
+        self.running = False
+
+        for thread in self.threads:
+            thread.capture.release()
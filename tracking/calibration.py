@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+"""
+Per-camera lens calibration, applied to detected coordinates only.
+
+Undistorting full frames with ``cv2.remap`` would cost about as much as the vision stages themselves. Instead, each
+camera's calibration profile is used to build a dense undistortion map once, which is cached on disk next to the
+profile and memory-mapped on later runs. Per frame, only the detected :class:`tracking.vision.Circle` coordinates are
+corrected, with a vectorized bilinear lookup into the map.
+
+Note that overlays drawn from corrected coordinates will not exactly line up with the (still distorted) frame.
+"""
+
+import os
+
+import cv2
+import numpy as np
+
+from pose import CameraIntrinsics
+
+#: The default directory for calibration profiles and cached undistortion maps
+CALIBRATION_DIR = os.path.join(os.path.expanduser('~'), '.tracking', 'calibration')
+
+# loaded profiles, keyed by path, along with the profile's modification time
+_profiles = {}
+
+
+class Calibration:
+    """
+    A camera calibration profile: camera matrix, distortion coefficients and image size.
+    """
+
+    def __init__(self, name, camera_matrix, dist_coeffs, size, directory = CALIBRATION_DIR):
+        """
+        :param name: the profile name, typically the camera name
+        :param camera_matrix: the 3x3 camera matrix
+        :param dist_coeffs: the distortion coefficients, as used by OpenCV
+        :param size: the image (width, height)
+        :param directory: the directory profiles and caches are stored in
+        """
+        self.name = name
+        self.camera_matrix = np.asarray(camera_matrix, dtype = float)
+        self.dist_coeffs = np.asarray(dist_coeffs, dtype = float)
+        self.size = tuple(int(v) for v in size)
+        self.directory = directory
+
+        self.map = None
+
+    @property
+    def path(self):
+        return os.path.join(self.directory, '%s.npz' % self.name)
+
+    @property
+    def map_path(self):
+        return os.path.join(self.directory, '%s.map.npy' % self.name)
+
+    @property
+    def intrinsics(self):
+        """
+        :return: a :class:`tracking.pose.CameraIntrinsics` for undistorted coordinates
+        """
+        m = self.camera_matrix
+
+        return CameraIntrinsics(m[0, 0], m[1, 1], m[0, 2], m[1, 2])
+
+    def save(self):
+        """
+        Writes this profile to disk, invalidating any cached undistortion map.
+        """
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+        np.savez(self.path, camera_matrix = self.camera_matrix, dist_coeffs = self.dist_coeffs,
+                 size = np.array(self.size))
+
+        if os.path.exists(self.map_path):
+            os.remove(self.map_path)
+
+    @classmethod
+    def load(cls, name, directory = CALIBRATION_DIR):
+        """
+        Loads a profile from disk. Profiles are memoized until the file changes.
+
+        :param name: the profile name
+        :param directory: the directory profiles are stored in
+        :return: a :class:`Calibration` instance
+        """
+        path = os.path.join(directory, '%s.npz' % name)
+        mtime = os.path.getmtime(path)
+
+        cached = _profiles.get(path)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+
+        data = np.load(path)
+        calibration = cls(name, data['camera_matrix'], data['dist_coeffs'], data['size'], directory)
+
+        _profiles[path] = (mtime, calibration)
+
+        return calibration
+
+    @classmethod
+    def from_chessboard(cls, name, frames, pattern = (9, 6), directory = CALIBRATION_DIR):
+        """
+        Calibrates a camera from a set of frames showing a chessboard.
+
+        :param name: the profile name
+        :param frames: a list of BGR frames
+        :param pattern: the number of inner (columns, rows) corners of the chessboard
+        :param directory: the directory to store the profile in
+        :return: a :class:`Calibration` instance, or None if no chessboard was found
+        """
+        corners = np.zeros((pattern[0] * pattern[1], 3), np.float32)
+        corners[:, :2] = np.mgrid[0:pattern[0], 0:pattern[1]].T.reshape(-1, 2)
+
+        object_points = []
+        image_points = []
+        for frame in frames:
+            gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+
+            found, found_corners = cv2.findChessboardCorners(gray, pattern)
+            if found:
+                object_points.append(corners)
+                image_points.append(found_corners)
+
+        if not image_points:
+            return None
+
+        height, width = frames[0].shape[:2]
+        ret, camera_matrix, dist_coeffs, rvecs, tvecs = cv2.calibrateCamera(
+            object_points, image_points, (width, height), None, None)
+
+        return cls(name, camera_matrix, dist_coeffs, (width, height), directory)
+
+    def undistort_map(self):
+        """
+        Returns the dense undistortion map: for each integer pixel, its undistorted (x, y) position. The map is
+        computed once and cached on disk, then memory-mapped on later runs.
+
+        :return: a (height, width, 2) float32 array
+        """
+        if self.map is not None:
+            return self.map
+
+        path = self.map_path
+        if os.path.exists(path) and os.path.exists(self.path) and \
+                os.path.getmtime(path) >= os.path.getmtime(self.path):
+            self.map = np.load(path, mmap_mode = 'r')
+            return self.map
+
+        width, height = self.size
+        grid = np.mgrid[0:height, 0:width][::-1].transpose(1, 2, 0).reshape(-1, 1, 2).astype(np.float32)
+
+        undistorted = cv2.undistortPoints(grid, self.camera_matrix, self.dist_coeffs, P = self.camera_matrix)
+        self.map = undistorted.reshape(height, width, 2)
+
+        if os.path.isdir(self.directory):
+            np.save(path, self.map)
+
+        return self.map
+
+    def undistort_points(self, points):
+        """
+        Undistorts image coordinates by bilinear interpolation into the undistortion map.
+
+        :param points: an n x 2 array of (x, y) image coordinates
+        :return: an n x 2 array of undistorted coordinates
+        """
+        table = self.undistort_map()
+        height, width = table.shape[:2]
+
+        x = np.clip(points[:, 0], 0, width - 1.001)
+        y = np.clip(points[:, 1], 0, height - 1.001)
+
+        x0 = x.astype(int)
+        y0 = y.astype(int)
+        fx = (x - x0)[:, None]
+        fy = (y - y0)[:, None]
+
+        top = table[y0, x0] * (1 - fx) + table[y0, x0 + 1] * fx
+        bottom = table[y0 + 1, x0] * (1 - fx) + table[y0 + 1, x0 + 1] * fx
+
+        return top * (1 - fy) + bottom * fy
+
+    def undistort_circles(self, circles):
+        """
+        Undistorts the coordinates of detected circles in place. Each circle's original image position is kept in its
+        ``raw`` attribute.
+
+        :param circles: a list of :class:`tracking.vision.Circle` instances
+        :return: the list of circles
+        """
+        if not circles:
+            return circles
+
+        points = np.array([(c.x, c.y) for c in circles], dtype = float)
+
+        for circle, (x, y) in zip(circles, self.undistort_points(points)):
+            circle.raw = (circle.x, circle.y)
+            circle.x = x
+            circle.y = y
+
+        return circles
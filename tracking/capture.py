@@ -0,0 +1,262 @@
+# -*- coding: utf-8 -*-
+"""
+Synchronized multi-camera capture.
+
+When each :class:`tracking.main.TrackingThread` reads its own camera, frames from different cameras are taken at
+unrelated times. A :class:`CaptureCoordinator` instead calls ``grab()`` on every camera back to back, so that all
+frames of a set are exposed as close together as possible, and only then runs the (much slower) ``retrieve()`` decode
+step for all cameras in parallel.
+
+Each set is delivered either as a timestamped :class:`FrameSet` (e.g. for :class:`tracking.batch.BatchedTracker`), or
+through one :class:`CameraChannel` per camera. A channel has the same ``read()`` and ``release()`` methods as
+``cv2.VideoCapture``, so it can be given to a :class:`tracking.main.TrackingThread` in place of a camera. Releasing a
+channel only detaches that camera's consumer; capture stops once every channel has been released.
+
+Video files can be used as sources to test without camera hardware, optionally paced to a fixed frame rate.
+"""
+
+import time
+
+import cv2
+
+from collections import namedtuple
+from multiprocessing.pool import ThreadPool
+from Queue import Queue, Empty, Full
+from threading import Thread
+
+from latency import monotonic
+
+#: The number of frame sets that may wait for a consumer before the oldest are dropped
+CAPTURE_QUEUE_SIZE = 2
+
+
+class FrameSet(namedtuple('FrameSet', 'sequence timestamps frames')):
+    """
+    One frame from each camera, with the monotonic time at which each frame was grabbed.
+    """
+
+    __slots__ = ()
+
+    @property
+    def skew(self):
+        """
+        :return: the time between the first and last grab of the set, in seconds
+        """
+        return max(self.timestamps) - min(self.timestamps)
+
+
+def put_latest(queue, item, drop = True):
+    """
+    Adds an item to a bounded queue. If the queue is full, either the oldest item is dropped, or this blocks.
+
+    :param queue: a ``Queue.Queue`` with a single producer
+    :param item: the item to add
+    :param drop: if True, drop the oldest item rather than block
+    :return: True if an item was dropped
+    """
+    if not drop:
+        queue.put(item)
+        return False
+
+    try:
+        queue.put_nowait(item)
+        return False
+    except Full:
+        pass
+
+    try:
+        queue.get_nowait()
+    except Empty:
+        pass
+
+    queue.put_nowait(item)
+
+    return True
+
+
+class CameraChannel:
+    """
+    Delivers a single camera's frames from a :class:`CaptureCoordinator`, with a ``cv2.VideoCapture``-like interface.
+    """
+
+    def __init__(self, coordinator, index, queue_size = CAPTURE_QUEUE_SIZE):
+        self.coordinator = coordinator
+        self.index = index
+        self.frames = Queue(maxsize = queue_size)
+
+        #: the grab time of the most recently read frame
+        self.timestamp = None
+
+        #: the number of frames dropped because this channel wasn't read in time
+        self.dropped = 0
+
+        #: whether the consumer has released this channel, after which no more frames are delivered to it
+        self.released = False
+
+    def read(self):
+        """
+        Waits for the next frame.
+
+        :return: a (success, frame) tuple; at the end of the stream, (False, None)
+        """
+        timestamp, frame = self.frames.get()
+        self.timestamp = timestamp
+
+        return frame is not None, frame
+
+    def release(self):
+        self.coordinator.detach(self)
+
+
+class CaptureCoordinator(Thread):
+    """
+    Captures synchronized frame sets from several cameras or video files.
+    """
+
+    def __init__(self, sources, queue_size = CAPTURE_QUEUE_SIZE, drop = True, fps = None, framesets = False,
+                 scheduler = None):
+        """
+        :param sources: a list of camera indices, video file paths, or already opened ``cv2.VideoCapture`` instances
+        :param queue_size: the number of frames that may wait in each channel, or frame sets in :attr:`sets`
+        :param drop: if True, slow consumers lose their oldest frames; if False, capture waits for every consumer,
+                     which is useful for processing every frame of video files
+        :param fps: if set, sets are captured at most this often, e.g. to play video files in real time
+        :param framesets: if True, complete :class:`FrameSet` instances are delivered through :meth:`get`, rather than
+                          frames through each camera's channel
+        :param scheduler: an optional :class:`tracking.scheduler.CoreScheduler`; when started, this thread is pinned
+                          to the cores budgeted for the ``capture`` stage
+        """
+        super(CaptureCoordinator, self).__init__(name = 'capture')
+        self.daemon = True
+
+        self.captures = []
+        for source in sources:
+            if not hasattr(source, 'grab'):
+                # noinspection PyArgumentList
+                source = cv2.VideoCapture(source)
+
+            self.captures.append(source)
+
+        self.drop = drop
+        self.fps = fps
+        self.framesets = framesets
+        self.scheduler = scheduler
+
+        self.channels = [CameraChannel(self, i, queue_size) for i in range(len(self.captures))]
+
+        #: complete :class:`FrameSet` instances, if enabled, for consumers that process all cameras together
+        self.sets = Queue(maxsize = queue_size)
+
+        self.pool = ThreadPool(len(self.captures))
+        self.sequence = 0
+        self.running = False
+
+        #: the number of frame sets dropped from :attr:`sets`
+        self.dropped = 0
+
+    def grab(self):
+        """
+        Grabs and decodes one frame from every camera.
+
+        :return: a :class:`FrameSet`, or None if any camera has no more frames
+        """
+        timestamps = []
+        for capture in self.captures:
+            if not capture.grab():
+                return None
+
+            timestamps.append(monotonic())
+
+        # decoding releases the GIL, so cameras decode in parallel
+        results = self.pool.map(lambda capture: capture.retrieve(), self.captures)
+        if not all(ret for ret, frame in results):
+            return None
+
+        frameset = FrameSet(self.sequence, timestamps, [frame for ret, frame in results])
+        self.sequence += 1
+
+        return frameset
+
+    def detach(self, channel):
+        """
+        Stops delivering frames to a channel, e.g. when its consumer exits. Capture stops once every channel is
+        detached.
+
+        :param channel: a :class:`CameraChannel` of this coordinator
+        """
+        channel.released = True
+
+        # unblock capture if it is waiting for space in the channel; as capture is the only producer and sees the
+        # channel as released from now on, it can add at most one more frame
+        while True:
+            try:
+                channel.frames.get_nowait()
+            except Empty:
+                break
+
+        if all(c.released for c in self.channels):
+            self.stop()
+
+    def get(self):
+        """
+        Waits for the next complete frame set.
+
+        :return: a :class:`FrameSet`, or None at the end of the stream
+        """
+        return self.sets.get()
+
+    def start(self):
+        # set before the thread runs, so a stop() (e.g. every channel being released) isn't lost
+        self.running = True
+        super(CaptureCoordinator, self).start()
+
+    def run(self):
+        if self.scheduler is not None:
+            self.scheduler.enter(self.name)
+
+        interval = None
+        if self.fps:
+            interval = 1.0 / self.fps
+
+        next_time = monotonic()
+        while self.running:
+            if interval is not None:
+                delay = next_time - monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+
+                next_time = max(next_time + interval, monotonic())
+
+            frameset = self.grab()
+            if frameset is None:
+                break
+
+            if self.framesets:
+                if put_latest(self.sets, frameset, self.drop):
+                    self.dropped += 1
+            else:
+                for channel, timestamp, frame in zip(self.channels, frameset.timestamps, frameset.frames):
+                    if channel.released:
+                        continue
+
+                    if put_latest(channel.frames, (timestamp, frame), self.drop):
+                        channel.dropped += 1
+
+        self.running = False
+
+        # signal the end of the stream to every consumer
+        if self.framesets:
+            put_latest(self.sets, None, self.drop)
+        else:
+            for channel in self.channels:
+                if not channel.released:
+                    put_latest(channel.frames, (None, None), self.drop)
+
+        for capture in self.captures:
+            capture.release()
+
+        self.pool.close()
+        self.pool.join()
+
+    def stop(self):
+        self.running = False
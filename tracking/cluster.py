@@ -7,14 +7,29 @@ from point import SimplePoint
 DISTANCE_MULTIPLIER = 35.0
 DISTANCE_PHYSICAL   = 12.0
 
+#: The minimum ratio of shortest to longest side for a 3-point cluster to be accepted as an equilateral triangle
+EQUILATERAL_TOLERANCE = 0.6
+
+cluster_index = 0
+
 
 class Cluster:
 
     def __init__(self, points):
+        global cluster_index
+        self.index = cluster_index
+        cluster_index += 1
+
         self.points = set(points)
 
         self.center = None
 
+        # the most recent tracking.pose.Pose, if solved
+        self.pose = None
+
+        # points split off by the shape gate, which may only rejoin this cluster once the triangle passes it again
+        self.rejected = set()
+
         self.update()
 
     def contains(self, point):
@@ -54,6 +69,8 @@ class Cluster:
         for point in to_remove:
             self.points.remove(point)
 
+        self.rejected = set(p for p in self.rejected if not p.is_expired(frame))
+
         self.update()
 
     @property
@@ -68,6 +85,19 @@ class Cluster:
     def is_dead(self):
         return len(self.points) < 2
 
+    @property
+    def color(self):
+        """
+        :return: the most common color label among this cluster's points, or None
+        """
+        colors = [point.color for point in self.points]
+        colors = [color for color in colors if color is not None]
+
+        if not colors:
+            return None
+
+        return max(set(colors), key = colors.count)
+
     def sum_of_distances(self):
         sum = 0
 
@@ -82,22 +112,50 @@ class Cluster:
     def distance(self):
         return (DISTANCE_MULTIPLIER / self.mean_distance()) * DISTANCE_PHYSICAL
 
-    def draw(self, image):
+    def overlay(self):
+        """
+        Computes this cluster's overlay geometry, so it can be drawn later (e.g. on another thread) even as points
+        continue to be updated.
+
+        :return: a (predicted points, predicted center, label, label position) tuple, with the points as an n x 2
+                 int32 array
+        """
         ppoints = list(self.predicted_points())
         pcenter = get_center(ppoints)
 
-        for point in ppoints:
-            cv2.line(image, point.pos, pcenter.pos, (0, 255, 0), 1)
+        vertices = np.array([point.pos for point in ppoints], dtype = np.int32).reshape(-1, 2)
+
+        return (vertices, pcenter.pos, "%.2f" % (self.distance()),
+                (int(self.center.x) + 5, int(self.center.y + 10)))
+
+    def draw(self, image):
+        draw_overlays(image, [self.overlay()])
+
 
-        cv2.circle(image, pcenter.pos, 4, (255, 255, 255), 2)
+def draw_overlays(image, overlays):
+    """
+    Draws cluster overlays onto an image, batching all lines of the same color into a single ``cv2.polylines`` call.
 
-        # pairs of point (i, i + 1)
-        # point n will be point (i, 0)
-        for a, b in zip(ppoints, ppoints[-1:] + ppoints[:-1]):
-            cv2.line(image, a.pos, b.pos, (0, 0, 255), 1)
+    :param image: the BGR image to draw on
+    :param overlays: a list of overlay tuples, see :meth:`Cluster.overlay`
+    """
+    spokes = []
+    outlines = []
+    for vertices, center, label, origin in overlays:
+        # each point is joined to the predicted center, and to the next point
+        spokes.extend(np.array([vertex, center], dtype = np.int32) for vertex in vertices)
+        outlines.append(vertices)
 
-        cv2.putText(image, "%.2f" % (self.distance()),
-                    (int(self.center.x) + 5, int(self.center.y + 10)),
+    if spokes:
+        cv2.polylines(image, spokes, False, (0, 255, 0), 1)
+
+    if outlines:
+        cv2.polylines(image, outlines, True, (0, 0, 255), 1)
+
+    for vertices, center, label, origin in overlays:
+        cv2.circle(image, center, 4, (255, 255, 255), 2)
+
+        cv2.putText(image, label, origin,
                     cv2.FONT_HERSHEY_SIMPLEX, 0.3, (255, 255, 255), lineType=cv2.LINE_AA)
 
 
@@ -120,13 +178,51 @@ def get_cluster(point, clusters):
     return None
 
 
-def find_clusters(points, clusters = None, max_radius = 75, max_length = 0):
+def validate_clusters(clusters, max_radius = 75):
+    """
+    Cheaply re-validates existing clusters against the updated positions of their members. Members that have drifted
+    further than ``max_radius`` from the cluster center are evicted, and clusters left with fewer than 2 points are
+    removed. The passed list of clusters will be modified.
+
+    :param clusters: a list of previously known clusters
+    :param max_radius: the maximum distance of any point from its cluster center
+    :return: the list of clusters
+    """
     max_radius_sq = max_radius**2
+
+    dead = []
+    for cluster in clusters:
+        cluster.update()
+
+        evicted = [p for p in cluster.points if cluster.center.distance_squared(p) > max_radius_sq]
+        if evicted:
+            for point in evicted:
+                cluster.points.remove(point)
+
+            cluster.update()
+
+        if cluster.is_dead:
+            dead.append(cluster)
+
+    for cluster in dead:
+        clusters.remove(cluster)
+
+    return clusters
+
+
+def find_pairs(search, points, max_radius = 75):
+    """
+    Finds all candidate point pairs close enough to form a cluster.
+
+    :param search: the points to find pairs for
+    :param points: the points to pair them with
+    :param max_radius: the maximum distance of any point from its cluster center
+    :return: a list of (a, b, squared distance) tuples
+    """
     max_radius_2sq = (max_radius * 2)**2
 
-    # minimum distance pairs
     distances_sq = []
-    for a in points:
+    for a in search:
         for b in points:
             if a is b:
                 continue
@@ -139,19 +235,140 @@ def find_clusters(points, clusters = None, max_radius = 75, max_length = 0):
             if dist_sq > max_radius_2sq:
                 continue
 
-            distances_sq.append((a, b, dist_sq, a.midpoint(b)))
+            distances_sq.append((a, b, dist_sq))
 
-    distances_sorted = sorted(distances_sq, key = lambda d: d[2])
+    return distances_sq
+
+
+def partition_by_color(points):
+    """
+    Buckets points by their color label (see :attr:`tracking.point.Point.color`). Points with no known color are
+    placed together in a ``None`` bucket.
+
+    :param points: a list of points
+    :return: a dict of color name to list of points
+    """
+    buckets = {}
+    for point in points:
+        buckets.setdefault(point.color, []).append(point)
+
+    return buckets
+
+
+def triangle_scores(clusters):
+    """
+    Scores 3-point clusters by how closely they form an equilateral triangle, as the ratio of the shortest to the
+    longest side, in a single vectorized pass.
+
+    :param clusters: a list of clusters, or of point lists, each with exactly 3 points
+    :return: an array of scores from 0.0 (degenerate) to 1.0 (equilateral)
+    """
+    if not clusters:
+        return np.empty(0)
+
+    # n x 3 x 2 array of vertices, and n x 3 array of side lengths
+    vertices = np.array([[(p.x, p.y) for p in getattr(c, 'points', c)] for c in clusters], dtype = float)
+    sides = np.sqrt(((vertices - np.roll(vertices, 1, axis = 1))**2).sum(axis = 2))
+
+    longest = sides.max(axis = 1)
+    longest[longest == 0] = np.inf
+
+    return sides.min(axis = 1) / longest
+
+
+def gate_clusters(clusters, tolerance = EQUILATERAL_TOLERANCE):
+    """
+    Applies the equilateral shape gate to all 3-point clusters. Clusters that fail are split by removing the point
+    furthest from the triangle's centroid, leaving a 2-point cluster that may find a better third point later. The
+    removed point is recorded as rejected by that cluster, so the same triangle isn't rebuilt (and split again) on
+    every frame; it may rejoin once the triangle it would complete passes the gate again, e.g. after briefly
+    foreshortened markers turn back towards the camera. The passed clusters will be modified.
+
+    :param clusters: a list of clusters
+    :param tolerance: the minimum :func:`triangle_scores` value for a cluster to pass
+    :return: the list of clusters
+    """
+    triangles = [c for c in clusters if c.size == 3]
+    if not triangles:
+        return clusters
+
+    failed = np.flatnonzero(triangle_scores(triangles) < tolerance)
+    if not len(failed):
+        return clusters
+
+    members = [list(triangles[i].points) for i in failed]
+    vertices = np.array([[(p.x, p.y) for p in m] for m in members], dtype = float)
+    centroids = vertices.mean(axis = 1)
+    outliers = ((vertices - centroids[:, None, :])**2).sum(axis = 2).argmax(axis = 1)
+
+    for i, member, outlier in zip(failed, members, outliers):
+        triangles[i].remove(member[outlier])
+        triangles[i].rejected.add(member[outlier])
+
+    return clusters
+
+
+def find_clusters(points, clusters = None, max_radius = 75, max_length = 0, incremental = False, by_color = False,
+                  shape_gate = False):
+    """
+    Groups points into clusters. Candidate point pairs are considered in ascending order of distance, either forming
+    new clusters or joining existing ones, provided no point would be further than ``max_radius`` from the cluster
+    center. The passed list of known clusters will be modified.
+
+    :param points: a list of acceptable points
+    :param clusters: a list of previously known clusters
+    :param max_radius: the maximum distance of any point from its cluster center
+    :param max_length: the maximum number of points per cluster, or 0 for no limit
+    :param incremental: if True, existing clusters are only re-validated (see :func:`validate_clusters`), and only
+                        points not already in a cluster enter the pair search, so the cost is proportional to the
+                        number of changed points rather than the total
+    :param by_color: if True, points are only paired with others of the same color label, as each cluster's dots are
+                     expected to share a unique color; this shrinks the pair search roughly by the number of colors in
+                     use and prevents cross-color clusters
+    :param shape_gate: if True, 3-point clusters that are not roughly equilateral are split (see
+                       :func:`gate_clusters`)
+    :return: the list of clusters
+    """
+    max_radius_sq = max_radius**2
 
-    # do a final pass to find minimum distance from centroid
     if clusters is None:
         clusters = []
 
+    if incremental:
+        validate_clusters(clusters, max_radius)
+
+    # map of each point to its cluster, rather than searching all clusters per pair
+    owners = {}
+    for cluster in clusters:
+        for point in cluster.points:
+            owners[point] = cluster
+
+    # pairs where both points are already clustered are skipped below anyway,
+    # so incrementally only pairs involving an unclustered point are needed
+    if incremental:
+        search = [p for p in points if p not in owners]
+    else:
+        search = points
+
+    # minimum distance pairs
+    if by_color:
+        buckets = partition_by_color(points)
+        search_set = set(search)
+
+        distances_sq = []
+        for bucket in buckets.values():
+            distances_sq.extend(find_pairs([p for p in bucket if p in search_set], bucket, max_radius))
+    else:
+        distances_sq = find_pairs(search, points, max_radius)
+
+    distances_sorted = sorted(distances_sq, key = lambda d: d[2])
+
+    # do a final pass to find minimum distance from centroid
     clusters_remaining = set(clusters)
 
-    for a, b, dist_sq, center in distances_sorted:
-        a_cluster = get_cluster(a, clusters)
-        b_cluster = get_cluster(b, clusters)
+    for a, b, dist_sq in distances_sorted:
+        a_cluster = owners.get(a)
+        b_cluster = owners.get(b)
 
         if a_cluster and b_cluster:
             # points have already been paired, move on
@@ -163,47 +380,49 @@ def find_clusters(points, clusters = None, max_radius = 75, max_length = 0):
             # new valid cluster from these points
             cluster = Cluster([a, b])
             clusters.append(cluster)
-        elif a_cluster and not b_cluster:
-            # we want to consider adding b to an existing cluster containing a
-            # simulate the addition first to ensure adding this point will not
-            # violate our max radius
-            if (max_length > 0) and a_cluster.size >= max_length:
-                continue
-
-            center_sim = a_cluster.sim_center(b)
 
-            valid = True
-            for point in list(a_cluster.points) + [center_sim]:
-                if center_sim.distance_squared(point) > max_radius_sq:
-                    valid = False
-                    break
-
-            if valid:
-                # append the point to the cluster and update the center
-                a_cluster.add(b)
-
-                if a_cluster in clusters_remaining:
-                    clusters_remaining.remove(a_cluster)
-        elif not a_cluster and b_cluster:
-            # same as above, but we want to add a into b's valid cluster
-            if (max_length > 0) and b_cluster.size >= max_length:
+            owners[a] = cluster
+            owners[b] = cluster
+        else:
+            # we want to consider adding the unclustered point to the existing
+            # cluster containing the other
+            if a_cluster:
+                cluster, point = a_cluster, b
+            else:
+                cluster, point = b_cluster, a
+
+            if (max_length > 0) and cluster.size >= max_length:
                 continue
 
-            center_sim = b_cluster.sim_center(a)
+            if point in cluster.rejected:
+                # split off by the shape gate, so only rejoin if the triangle would now pass it
+                if cluster.size != 2 or \
+                        triangle_scores([list(cluster.points) + [point]])[0] < EQUILATERAL_TOLERANCE:
+                    continue
+
+            # simulate the addition first to ensure adding this point will not
+            # violate our max radius
+            center_sim = cluster.sim_center(point)
 
             valid = True
-            for point in list(b_cluster.points) + [center_sim]:
-                if center_sim.distance_squared(point) > max_radius_sq:
+            for member in list(cluster.points) + [center_sim]:
+                if center_sim.distance_squared(member) > max_radius_sq:
                     valid = False
                     break
 
             if valid:
-                b_cluster.add(a)
+                # append the point to the cluster and update the center
+                cluster.add(point)
+                cluster.rejected.discard(point)
+                owners[point] = cluster
 
-                if b_cluster in clusters_remaining:
-                    clusters_remaining.remove(b_cluster)
+                if cluster in clusters_remaining:
+                    clusters_remaining.remove(cluster)
 
     for cluster in clusters_remaining:
         cluster.update()
 
+    if shape_gate:
+        gate_clusters(clusters)
+
     return clusters
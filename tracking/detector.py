@@ -0,0 +1,422 @@
+# -*- coding: utf-8 -*-
+"""
+Pluggable circle detectors.
+
+A detector takes a raw camera frame and produces a list of candidate :class:`tracking.vision.Circle` instances, which
+can then be passed to :func:`tracking.point.find_points`. A :class:`tracking.main.TrackingThread` accepts any
+:class:`Detector`, so the cheapest implementation that meets accuracy needs can be chosen for each camera and lighting
+setup.
+"""
+
+import zlib
+
+import cv2
+import numpy as np
+
+from collections import OrderedDict
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+from threading import Lock
+from timeit import default_timer
+
+from vision import Circle, FrameBuffers, preprocess, find_edges, find_circles, circle_color, offset_circles, \
+    scale_circles, EROSION_ITERATIONS, MIN_AREA, MAX_AREA
+
+#: Rows of overlap added above and below each tile by :class:`TiledContourDetector`. This must cover the largest
+#: circle radius accepted by :func:`tracking.vision.find_circles` (25) plus the reach of the erosion (15 iterations of
+#: a 3x3 kernel), blur (5x5) and Canny (3x3) kernels, so that results within a tile's own rows are exact.
+TILE_HALO = 25 + 15 + 2 + 2
+
+#: The number of distinct frames remembered by a :class:`CachingDetector`
+CACHE_SIZE = 4
+
+_pool = None
+_pool_lock = Lock()
+
+
+def get_pool():
+    """
+    Returns the thread pool shared by all tiled detectors, creating it if necessary. OpenCV releases the GIL, so a
+    single pool with one worker per core is enough for all cameras.
+
+    :return: a ``multiprocessing.pool.ThreadPool``
+    """
+    global _pool
+
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPool(cpu_count())
+
+    return _pool
+
+
+class Detector(object):
+    """
+    Base class for circle detectors. Subclasses must implement :meth:`detect`, and may override :meth:`preprocess`.
+    """
+
+    #: A short name used when reporting, e.g. in :func:`benchmark`
+    name = 'detector'
+
+    #: The attributes that may be changed between frames, e.g. by :class:`tracking.governor.QualityGovernor`
+    knobs = ()
+
+    def preprocess(self, frame, buffers = None):
+        """
+        Prepares a raw frame for detection. The returned frame is also used for display, so it should remain a BGR
+        image of the same size.
+
+        :param frame: the raw BGR frame
+        :param buffers: an optional :class:`tracking.vision.FrameBuffers` arena
+        :return: the preprocessed frame
+        """
+        return frame
+
+    def detect(self, frame, frame_count, buffers = None):
+        """
+        Locates candidate circles in a preprocessed frame.
+
+        :param frame: the preprocessed BGR frame
+        :param frame_count: the current frame number
+        :param buffers: an optional :class:`tracking.vision.FrameBuffers` arena
+        :return: a list of :class:`tracking.vision.Circle` instances
+        """
+        raise NotImplementedError()
+
+    def process(self, frame, frame_count, buffers = None):
+        """
+        Preprocesses and runs detection on a raw frame.
+
+        :param frame: the raw BGR frame
+        :param frame_count: the current frame number
+        :param buffers: an optional :class:`tracking.vision.FrameBuffers` arena
+        :return: a (preprocessed frame, circles) tuple
+        """
+        frame = self.preprocess(frame, buffers)
+
+        return frame, self.detect(frame, frame_count, buffers)
+
+    def detect_regions(self, frame, frame_count, regions):
+        """
+        Runs detection only within the given regions of a preprocessed frame. Each region is extended by
+        :data:`.TILE_HALO` pixels so results near its edges are unaffected, and only circles centered within the
+        region itself are kept; regions should therefore not overlap.
+
+        :param frame: the preprocessed BGR frame
+        :param frame_count: the current frame number
+        :param regions: a list of (x, y, width, height) rectangles
+        :return: a list of :class:`tracking.vision.Circle` instances, in full frame coordinates
+        """
+        height, width = frame.shape[:2]
+
+        circles = []
+        for x, y, w, h in regions:
+            x0, y0 = max(0, x - TILE_HALO), max(0, y - TILE_HALO)
+            x1, y1 = min(width, x + w + TILE_HALO), min(height, y + h + TILE_HALO)
+
+            found = self.detect(frame[y0:y1, x0:x1], frame_count)
+            owned = [c for c in found if x <= c.x + x0 < x + w and y <= c.y + y0 < y + h]
+
+            circles.extend(offset_circles(owned, x0, y0))
+
+        return circles
+
+
+class ContourDetector(Detector):
+    """
+    The default detector: a dark-region mask followed by Canny edge detection and contour analysis. See
+    :func:`tracking.vision.find_edges` and :func:`tracking.vision.find_circles`.
+    """
+
+    name = 'contour'
+
+    knobs = ('scale', 'erosion', 'min_area', 'max_area')
+
+    def __init__(self, scale = 1.0, erosion = EROSION_ITERATIONS, min_area = MIN_AREA, max_area = MAX_AREA):
+        """
+        :param scale: the factor frames are resized by before edge detection; below 1.0 is cheaper but less precise
+        :param erosion: the number of search area erosion iterations, at full resolution
+        :param min_area: the minimum contour area of a circle, in full resolution pixels
+        :param max_area: the maximum contour area of a circle, in full resolution pixels
+        """
+        self.scale = scale
+        self.erosion = erosion
+        self.min_area = min_area
+        self.max_area = max_area
+
+    def preprocess(self, frame, buffers = None):
+        return preprocess(frame, buffers)
+
+    def detect(self, frame, frame_count, buffers = None):
+        if self.scale == 1.0:
+            edges = find_edges(frame, buffers, self.erosion)
+
+            return find_circles(frame, frame_count, edges, buffers, self.min_area, self.max_area)
+
+        # frames are already blurred by preprocessing, so linear interpolation is enough
+        small = cv2.resize(frame, None, fx = self.scale, fy = self.scale, interpolation = cv2.INTER_LINEAR)
+
+        small_buffers = None
+        if buffers is not None:
+            small_buffers = buffers.tile('scaled')
+
+        edges = find_edges(small, small_buffers, max(1, int(round(self.erosion * self.scale))))
+        circles = find_circles(small, frame_count, edges, small_buffers,
+                               self.min_area * self.scale**2, self.max_area * self.scale**2)
+
+        return scale_circles(circles, 1.0 / self.scale)
+
+
+class TiledContourDetector(ContourDetector):
+    """
+    A :class:`ContourDetector` that splits each frame into horizontal strips and processes them in parallel on the
+    shared thread pool (see :func:`get_pool`), allowing a single high-resolution camera to use all cores.
+
+    Each strip is extended by :data:`.TILE_HALO` rows of overlap on either side. A circle is only kept by the strip
+    that owns the row containing its center, so circles straddling a boundary are reported exactly once.
+    """
+
+    name = 'tiled'
+
+    knobs = ('erosion', 'min_area', 'max_area')
+
+    def __init__(self, tiles = None, pool = None, **kwargs):
+        """
+        :param tiles: the number of strips, by default the number of cores
+        :param pool: a thread pool to use instead of the shared pool
+        :param kwargs: the erosion and area limits, see :class:`ContourDetector`; scaling is not supported
+        """
+        super(TiledContourDetector, self).__init__(**kwargs)
+
+        if tiles is None:
+            tiles = cpu_count()
+
+        self.tiles = tiles
+        self.pool = pool
+
+    def _run(self, frame, frame_count, buffers, output):
+        height = frame.shape[0]
+        tiles = max(1, min(self.tiles, height // TILE_HALO))
+        rows = [(height * i) // tiles for i in range(tiles + 1)]
+
+        def work(index):
+            y0, y1 = rows[index], rows[index + 1]
+            h0, h1 = max(0, y0 - TILE_HALO), min(height, y1 + TILE_HALO)
+
+            tile_buffers = None
+            if buffers is not None:
+                tile_buffers = buffers.tile(index)
+
+            tile = frame[h0:h1]
+            if output is not None:
+                tile = preprocess(tile, tile_buffers)
+                output[y0:y1] = tile[y0 - h0:y1 - h0]
+
+            edges = find_edges(tile, tile_buffers, self.erosion)
+            circles = find_circles(tile, frame_count, edges, tile_buffers, self.min_area, self.max_area)
+
+            # keep only circles centered in this tile's own rows
+            owned = [c for c in circles if y0 <= c.y + h0 < y1]
+
+            return offset_circles(owned, 0, h0)
+
+        pool = self.pool
+        if pool is None:
+            pool = get_pool()
+
+        circles = []
+        for tile_circles in pool.map(work, range(tiles)):
+            circles.extend(tile_circles)
+
+        return circles
+
+    def detect(self, frame, frame_count, buffers = None):
+        return self._run(frame, frame_count, buffers, None)
+
+    def process(self, frame, frame_count, buffers = None):
+        if buffers is None:
+            output = np.empty_like(frame)
+        else:
+            buffers.ensure(frame)
+            output = buffers.next_output()
+
+        circles = self._run(frame, frame_count, buffers, output)
+
+        return output, circles
+
+
+class BlobDetector(Detector):
+    """
+    A detector based on ``cv2.SimpleBlobDetector``. Blobs are located in a grayscale image with area and circularity
+    filters roughly equivalent to those in :func:`tracking.vision.find_circles`.
+
+    As blob keypoints carry no contour, circularity is reported as the configured minimum.
+    """
+
+    name = 'blob'
+
+    def __init__(self, min_area = 30, max_area = 700, min_circularity = 0.60):
+        params = cv2.SimpleBlobDetector_Params()
+        params.filterByArea = True
+        params.minArea = min_area
+        params.maxArea = max_area
+        params.filterByCircularity = True
+        params.minCircularity = min_circularity
+        params.filterByConvexity = False
+        params.filterByInertia = False
+
+        # stickers are brighter than the black tracking surface
+        params.filterByColor = True
+        params.blobColor = 255
+
+        self.circularity = min_circularity
+        self.blob_detector = cv2.SimpleBlobDetector_create(params)
+
+    def preprocess(self, frame, buffers = None):
+        return preprocess(frame, buffers)
+
+    def detect(self, frame, frame_count, buffers = None):
+        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+
+        circles = []
+        for keypoint in self.blob_detector.detect(gray):
+            x, y = keypoint.pt
+            radius = keypoint.size / 2.0
+
+            color = circle_color(frame, x, y, radius)
+            circles.append(Circle(frame_count, None, color, x, y, radius, self.circularity))
+
+        return circles
+
+
+class HoughDetector(Detector):
+    """
+    A detector based on ``cv2.HoughCircles``, using the gradient method on a median-blurred grayscale image.
+
+    Hough circles are fitted shapes, so circularity is always reported as 1.0.
+    """
+
+    name = 'hough'
+
+    def __init__(self, min_radius = 2, max_radius = 25, min_distance = 8, canny_threshold = 100,
+                 accumulator_threshold = 10):
+        self.min_radius = min_radius
+        self.max_radius = max_radius
+        self.min_distance = min_distance
+        self.canny_threshold = canny_threshold
+        self.accumulator_threshold = accumulator_threshold
+
+    def preprocess(self, frame, buffers = None):
+        return cv2.medianBlur(frame, 5)
+
+    def detect(self, frame, frame_count, buffers = None):
+        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+
+        found = cv2.HoughCircles(gray, cv2.HOUGH_GRADIENT, 1, self.min_distance,
+                                 param1 = self.canny_threshold,
+                                 param2 = self.accumulator_threshold,
+                                 minRadius = self.min_radius,
+                                 maxRadius = self.max_radius)
+
+        circles = []
+        if found is None:
+            return circles
+
+        for x, y, radius in found[0]:
+            color = circle_color(frame, x, y, radius)
+            circles.append(Circle(frame_count, None, color, x, y, radius, 1.0))
+
+        return circles
+
+
+class CachingDetector(Detector):
+    """
+    Wraps another detector, remembering the results for recently seen frames. A frame whose content is identical to a
+    remembered one (e.g. a still image fed repeatedly, or a stalled camera delivering duplicate frames) skips the
+    vision stages entirely, and only costs a checksum.
+
+    Frames are keyed by their shape and CRC-32. Only :meth:`process` is cached; :meth:`preprocess` and :meth:`detect`
+    are passed through. Cached output frames are shared between hits, so they are marked read-only.
+    """
+
+    name = 'caching'
+
+    def __init__(self, detector, size = CACHE_SIZE):
+        """
+        :param detector: the :class:`Detector` to wrap
+        :param size: the number of frames to remember
+        """
+        self.detector = detector
+        self.size = size
+        self.cache = OrderedDict()
+
+        #: the number of frames found in the cache
+        self.hits = 0
+
+        #: the number of frames that had to be processed
+        self.misses = 0
+
+    def clear(self):
+        """
+        Forgets all remembered frames, e.g. after the wrapped detector's knobs are changed.
+        """
+        self.cache.clear()
+
+    def preprocess(self, frame, buffers = None):
+        return self.detector.preprocess(frame, buffers)
+
+    def detect(self, frame, frame_count, buffers = None):
+        return self.detector.detect(frame, frame_count, buffers)
+
+    def process(self, frame, frame_count, buffers = None):
+        key = (frame.shape, zlib.crc32(np.ascontiguousarray(frame)))
+
+        cached = self.cache.pop(key, None)
+        if cached is None:
+            self.misses += 1
+
+            output, circles = self.detector.process(frame, frame_count, buffers)
+
+            # the output may be a reused buffer, and circles may later be modified in place
+            output = output.copy()
+            output.flags.writeable = False
+            cached = (output, [c.copy(frame_count) for c in circles])
+
+            if len(self.cache) >= self.size:
+                self.cache.popitem(last = False)
+        else:
+            self.hits += 1
+
+        self.cache[key] = cached
+
+        output, circles = cached
+
+        return output, [c.copy(frame_count) for c in circles]
+
+
+def benchmark(frame, detectors = None, iterations = 50):
+    """
+    Runs several detectors against the same input frame and reports their cost. Useful to pick the cheapest detector
+    for a particular camera and lighting setup.
+
+    :param frame: a raw BGR frame
+    :param detectors: a list of :class:`Detector` instances; by default, one of each built-in detector
+    :param iterations: the number of times to run each detector
+    :return: a list of (name, mean seconds per frame, number of circles found) tuples
+    """
+    if detectors is None:
+        detectors = [ContourDetector(), BlobDetector(), HoughDetector()]
+
+    results = []
+    for detector in detectors:
+        circles = []
+        buffers = FrameBuffers()
+
+        start = default_timer()
+        for i in range(iterations):
+            _, circles = detector.process(frame, i, buffers)
+        elapsed = default_timer() - start
+
+        results.append((detector.name, elapsed / iterations, len(circles)))
+
+    return results
@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+"""
+Adaptive detection interval, with optical flow tracking between full detections.
+
+When markers move smoothly, running the full vision stack every frame is largely wasted work. A :class:`FlowTracker`
+runs full detection every N frames, or whenever tracking confidence drops; on the frames in between, known points are
+advanced with sparse pyramidal Lucas-Kanade optical flow, which only examines small windows around each point. The
+interval N adapts to measured motion and track quality.
+
+Only confirmed points (see :data:`tracking.motion.CARRY_QUALITY`) are flowed. Unconfirmed ones, e.g. noise, are held
+without gaining or losing health until the next full detection, so they are confirmed or expire through detection
+alone.
+
+Flow is computed on the frames as captured, so points are tracked from their sub-pixel image positions (see
+:attr:`tracking.point.Point.raw_pos`), and the tracked circles are undistorted afterwards like detected ones.
+"""
+
+import cv2
+import numpy as np
+
+from motion import CARRY_QUALITY
+from vision import Circle
+
+#
+# Tunables
+#
+
+#: The longest allowed interval between full detections, in frames
+MAX_INTERVAL = 8
+
+#: Below this median motion, in pixels per frame, the detection interval is lengthened
+SLOW_MOTION = 1.5
+
+#: Above this median motion, in pixels per frame, the detection interval is shortened
+FAST_MOTION = 6.0
+
+#: If more than this fraction of points is lost by optical flow, full detection runs on the next frame
+MAX_LOST_FRACTION = 0.2
+
+#: The maximum Lucas-Kanade error for a point to be considered tracked
+MAX_FLOW_ERROR = 12.0
+
+#
+# End of tunables
+#
+
+lk_params = dict(
+    winSize = (9, 9),
+    maxLevel = 2,
+    criteria = (cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, 10, 0.03)
+)
+
+
+class FlowTracker:
+    """
+    Decides when full detection is needed, and tracks points with optical flow otherwise. Used by
+    :class:`tracking.main.TrackingThread` when given as its ``flow`` argument.
+    """
+
+    def __init__(self, max_interval = MAX_INTERVAL):
+        self.max_interval = max_interval
+
+        #: the current interval between full detections, in frames
+        self.interval = 1
+
+        #: a lower bound on the interval, e.g. set by :class:`tracking.governor.QualityGovernor` to save time
+        self.min_interval = 1
+
+        self.since_detection = 0
+        self.force = True
+        self.previous = None
+
+        #: the median point motion, in pixels, measured on the most recent flow frame
+        self.motion = 0.0
+
+        #: the fraction of confirmed points lost on the most recent flow frame
+        self.lost = 0.0
+
+        #: the unconfirmed points skipped on the most recent flow frame, which keep their state until detection
+        self.held = []
+
+    def should_detect(self, points):
+        """
+        :param points: the currently known points
+        :return: True if full detection should run on the next frame
+        """
+        if self.force or self.previous is None:
+            return True
+
+        # with no confirmed points, there is nothing to flow
+        if not any(p.quality > CARRY_QUALITY for p in points):
+            return True
+
+        return self.since_detection >= max(self.interval, self.min_interval)
+
+    def detected(self, frame):
+        """
+        Notifies the tracker that full detection ran on the given (preprocessed) frame.
+        """
+        self.previous = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        self.since_detection = 0
+        self.force = False
+
+    def track(self, frame, points, frame_count):
+        """
+        Advances known points to the given frame with optical flow, and adapts the detection interval.
+
+        :param frame: the preprocessed BGR frame
+        :param points: the currently known points
+        :param frame_count: the current frame number
+        :return: a list of synthetic :class:`tracking.vision.Circle` instances at the tracked positions of confirmed
+                 points, in image space
+        """
+        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        previous, self.previous = self.previous, gray
+        self.since_detection += 1
+
+        # unconfirmed points are left to full detection, so noise isn't kept alive by flow
+        tracked = [p for p in points if p.quality > CARRY_QUALITY]
+        self.held = [p for p in points if p.quality <= CARRY_QUALITY]
+        if not tracked:
+            self.force = True
+            return []
+
+        start = np.array([[p.raw_pos] for p in tracked], dtype = np.float32)
+        end, status, error = cv2.calcOpticalFlowPyrLK(previous, gray, start, None, **lk_params)
+
+        good = (status[:, 0] == 1) & (error[:, 0] < MAX_FLOW_ERROR)
+
+        self.lost = 1.0 - np.count_nonzero(good) / float(len(tracked))
+        if good.any():
+            self.motion = float(np.median(np.sqrt(((end - start)[good, 0]**2).sum(axis = 1))))
+
+        # adapt the interval: detect immediately if confidence drops, back off
+        # quickly on fast motion, and extend slowly while motion is slow
+        if self.lost > MAX_LOST_FRACTION:
+            self.force = True
+            self.interval = max(1, self.interval // 2)
+        elif self.motion > FAST_MOTION:
+            self.interval = max(1, self.interval // 2)
+        elif self.motion < SLOW_MOTION:
+            self.interval = min(self.max_interval, self.interval + 1)
+
+        # convert from numpy scalars, which are much slower in the per-pair matching of find_points()
+        return [Circle.from_point(p, frame_count, float(x), float(y))
+                for p, (x, y), ok in zip(tracked, end[:, 0].tolist(), good) if ok]
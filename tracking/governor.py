@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+"""
+Adaptive quality control to hold a target frame rate.
+
+A :class:`QualityGovernor` watches how long each frame of a :class:`tracking.main.TrackingThread` takes to process,
+from the frame's ``start`` stage (see :attr:`tracking.latency.FrameTrace.processing_time`), so that time spent
+grabbing, decoding or queued, which quality settings can't reduce, is not counted.
+When frames take longer than the target frame rate allows, it steps down a ladder of :data:`.QUALITY_LEVELS`, each
+cheaper than the last. When there is enough headroom, it steps back up. The knobs, from cheapest to most expensive
+in lost quality, are:
+
+ - ``erosion``: search area erosion iterations, see :func:`tracking.vision.find_search_area`
+ - ``interval``: the minimum interval between full detections, with optical flow tracking in between (see
+   :mod:`tracking.flow`)
+ - ``roi``: whether detection is restricted to changed regions of the frame (see :mod:`tracking.motion`)
+ - ``scale``: the factor frames are resized by before edge detection
+ - ``min_area`` and ``max_area``: the contour area limits of candidate circles, see
+   :func:`tracking.vision.find_circles`
+
+Detector knobs only apply to detectors that list them in their ``knobs`` attribute, such as
+:class:`tracking.detector.ContourDetector`; a :class:`tracking.detector.CachingDetector` is looked through to the
+detector it wraps. Knobs that don't apply are skipped, logged once, and left out of :meth:`QualityGovernor.metrics`.
+If a thread has no flow tracker or motion gate of its own, the governor adds one while it is needed.
+
+Every adjustment is logged with the ``logging`` module, and recorded in :meth:`QualityGovernor.metrics`.
+"""
+
+import logging
+
+from collections import deque
+
+from detector import CachingDetector
+from flow import FlowTracker
+from motion import MotionGate
+from vision import EROSION_ITERATIONS, MIN_AREA, MAX_AREA
+
+#
+# Tunables
+#
+
+#: The number of frames averaged before each decision
+GOVERNOR_WINDOW = 30
+
+#: Quality is reduced if the mean frame time exceeds this fraction of the frame budget
+DEGRADE_THRESHOLD = 0.95
+
+#: Quality is restored if the mean frame time is below this fraction of the frame budget
+RESTORE_THRESHOLD = 0.6
+
+#: The number of adjustments kept in the history reported by :meth:`QualityGovernor.metrics`
+HISTORY_LENGTH = 100
+
+#
+# End of tunables
+#
+
+#: The quality ladder, from full quality (level 0) to cheapest
+QUALITY_LEVELS = [
+    dict(erosion = EROSION_ITERATIONS, interval = 1, roi = False, scale = 1.0, min_area = MIN_AREA, max_area = MAX_AREA),
+    dict(erosion = 10, interval = 1, roi = False, scale = 1.0, min_area = MIN_AREA, max_area = MAX_AREA),
+    dict(erosion = 10, interval = 2, roi = False, scale = 1.0, min_area = MIN_AREA, max_area = MAX_AREA),
+    dict(erosion = 10, interval = 2, roi = True, scale = 1.0, min_area = MIN_AREA, max_area = MAX_AREA),
+    dict(erosion = 8, interval = 3, roi = True, scale = 0.75, min_area = 40, max_area = MAX_AREA),
+    dict(erosion = 6, interval = 4, roi = True, scale = 0.5, min_area = 50, max_area = 500)
+]
+
+DETECTOR_KNOBS = ('erosion', 'scale', 'min_area', 'max_area')
+
+log = logging.getLogger(__name__)
+
+
+class QualityGovernor:
+    """
+    Adjusts the cost of a single :class:`tracking.main.TrackingThread` to hold a target frame rate. Used by the thread
+    when given as its ``governor`` argument.
+    """
+
+    def __init__(self, target_fps, levels = QUALITY_LEVELS, window = GOVERNOR_WINDOW):
+        """
+        :param target_fps: the frame rate to hold, in frames per second
+        :param levels: the quality ladder, a list of knob settings from best to cheapest
+        :param window: the number of frames averaged before each decision
+        """
+        self.target_fps = target_fps
+        self.budget = 1.0 / target_fps
+        self.levels = levels
+
+        self.frame_times = deque(maxlen = window)
+
+        #: the current quality level, an index into :attr:`levels`
+        self.level = 0
+
+        #: a list of (frame number, old level, new level, mean frame time) tuples
+        self.history = deque(maxlen = HISTORY_LENGTH)
+
+        # a flow tracker or motion gate added by the governor, rather than given to the thread
+        self.flow = None
+        self.motion = None
+
+        #: the detector knobs that don't apply to the thread's detector, and so are never changed
+        self.skipped = set()
+
+    def update(self, thread, trace):
+        """
+        Records a processed frame, and adjusts quality if necessary.
+
+        :param thread: the :class:`tracking.main.TrackingThread` that processed the frame
+        :param trace: the frame's :class:`tracking.latency.FrameTrace`
+        """
+        self.frame_times.append(trace.processing_time)
+        if len(self.frame_times) < self.frame_times.maxlen:
+            return
+
+        mean = sum(self.frame_times) / len(self.frame_times)
+
+        level = self.level
+        if mean > self.budget * DEGRADE_THRESHOLD and level < len(self.levels) - 1:
+            level += 1
+        elif mean < self.budget * RESTORE_THRESHOLD and level > 0:
+            level -= 1
+        else:
+            return
+
+        log.info("%s: %.1f ms per frame against a %.1f ms budget, quality level %d -> %d",
+                 thread.name, mean * 1000, self.budget * 1000, self.level, level)
+
+        self.history.append((thread.frame_count, self.level, level, mean))
+        self.level = level
+        self.apply(thread)
+
+        # wait for a full window at the new level before deciding again
+        self.frame_times.clear()
+
+    def apply(self, thread):
+        """
+        Applies the knob settings of the current level to a thread.
+
+        :param thread: a :class:`tracking.main.TrackingThread`
+        """
+        settings = self.levels[self.level]
+
+        # look through caches, which must be cleared once the detector's results change
+        detector = thread.detector
+        caches = []
+        while isinstance(detector, CachingDetector):
+            caches.append(detector)
+            detector = detector.detector
+
+        changed = False
+        for knob in DETECTOR_KNOBS:
+            if knob not in settings:
+                continue
+
+            if knob not in getattr(detector, 'knobs', ()):
+                if knob not in self.skipped:
+                    log.info("%s: %s does not support %s, skipped", thread.name, type(detector).__name__, knob)
+                    self.skipped.add(knob)
+
+                continue
+
+            if getattr(detector, knob) != settings[knob]:
+                setattr(detector, knob, settings[knob])
+                changed = True
+
+        if changed:
+            for cache in caches:
+                cache.clear()
+
+        interval = settings.get('interval', 1)
+        if interval > 1 and thread.flow is None:
+            self.flow = thread.flow = FlowTracker()
+        elif interval == 1 and thread.flow is not None and thread.flow is self.flow:
+            self.flow = thread.flow = None
+
+        if thread.flow is not None:
+            thread.flow.min_interval = interval
+            thread.flow.max_interval = max(thread.flow.max_interval, interval)
+
+        roi = settings.get('roi', False)
+        if roi and thread.motion is None:
+            self.motion = thread.motion = MotionGate()
+        elif not roi and thread.motion is not None and thread.motion is self.motion:
+            self.motion = thread.motion = None
+
+    def metrics(self):
+        """
+        :return: a dict of the current level, its applicable settings, the skipped detector knobs, the recent mean
+                 frame time and frame rate, and the history of adjustments
+        """
+        mean = None
+        fps = None
+        if self.frame_times:
+            mean = sum(self.frame_times) / len(self.frame_times)
+            if mean > 0:
+                fps = 1.0 / mean
+
+        return {
+            'target_fps': self.target_fps,
+            'level': self.level,
+            'settings': dict((knob, value) for knob, value in self.levels[self.level].items()
+                             if knob not in self.skipped),
+            'skipped': sorted(self.skipped),
+            'frame_time': mean,
+            'fps': fps,
+            'adjustments': len(self.history),
+            'history': list(self.history)
+        }
@@ -0,0 +1,234 @@
+# -*- coding: utf-8 -*-
+"""
+End-to-end latency tracing, from frame capture to consumer receipt.
+
+Each frame processed by a :class:`tracking.main.TrackingThread` carries a :class:`FrameTrace`, stamped with a monotonic
+capture time and the time at which each processing stage finished. Consumers add received traces to per-camera
+:class:`LatencyStats`, and optionally to a :class:`TraceRecorder` for viewing in a Chrome trace-event viewer (e.g.
+``chrome://tracing``).
+"""
+
+import ctypes
+import ctypes.util
+import json
+import os
+import platform
+import numpy as np
+
+from collections import deque
+from threading import current_thread
+
+# the clock id of CLOCK_MONOTONIC on Linux
+CLOCK_MONOTONIC = 1
+
+
+class timespec(ctypes.Structure):
+    _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+
+def _clock_gettime():
+    """
+    :return: the C library's ``clock_gettime`` function, or None if unavailable
+    """
+    if platform.system() != 'Linux':
+        return None
+
+    try:
+        # older C libraries only provide clock_gettime in librt
+        library = ctypes.CDLL(ctypes.util.find_library('rt') or ctypes.util.find_library('c'), use_errno = True)
+        clock_gettime = library.clock_gettime
+    except (OSError, AttributeError):
+        return None
+
+    clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+
+    return clock_gettime
+
+
+try:
+    from time import monotonic
+except ImportError:
+    # python 2 has no monotonic clock in the standard library, and its timers follow the wall clock, which can jump
+    clock_gettime = _clock_gettime()
+
+    if clock_gettime is not None:
+        def monotonic():
+            """
+            :return: the value of ``CLOCK_MONOTONIC``, in seconds
+            """
+            t = timespec()
+            if clock_gettime(CLOCK_MONOTONIC, ctypes.byref(t)) != 0:
+                error = ctypes.get_errno()
+                raise OSError(error, os.strerror(error))
+
+            return t.tv_sec + t.tv_nsec * 1e-9
+    else:
+        from timeit import default_timer as monotonic
+
+#: The number of frames of latency history kept per camera
+LATENCY_WINDOW = 300
+
+
+def read_frame(capture):
+    """
+    Reads a frame and its capture time. A ``cv2.VideoCapture`` frame is stamped between ``grab()`` and ``retrieve()``,
+    so decoding counts towards latency but waiting for the camera does not. Other captures are stamped before
+    ``read()``, unless they know when the frame was grabbed and provide a ``timestamp`` attribute (e.g. a
+    :class:`tracking.capture.CameraChannel`).
+
+    :param capture: a ``cv2.VideoCapture``, or an object with a compatible ``read()`` method
+    :return: a (frame, capture time) tuple; the frame is None at the end of the stream
+    """
+    if hasattr(capture, 'grab'):
+        if not capture.grab():
+            return None, monotonic()
+
+        capture_time = monotonic()
+        ret, frame = capture.retrieve()
+        return frame, capture_time
+
+    capture_time = monotonic()
+    ret, frame = capture.read()
+
+    timestamp = getattr(capture, 'timestamp', None)
+    if timestamp is not None:
+        capture_time = timestamp
+
+    return frame, capture_time
+
+
+class FrameTrace(object):
+    """
+    Timing information for a single frame. Stages are recorded in order as (name, time, thread name) tuples, each
+    marking the time at which the stage finished. A ``start`` stage marks when processing began, so that it can be told
+    apart from time spent grabbing, decoding and waiting in queues.
+    """
+
+    __slots__ = ('camera', 'frame_count', 'capture_time', 'stages')
+
+    def __init__(self, camera, frame_count, capture_time = None):
+        if capture_time is None:
+            capture_time = monotonic()
+
+        self.camera = camera
+        self.frame_count = frame_count
+        self.capture_time = capture_time
+        self.stages = []
+
+    def mark(self, stage):
+        """
+        Records the end of a processing stage.
+
+        :param stage: the stage name
+        """
+        self.stages.append((stage, monotonic(), current_thread().name))
+
+    @property
+    def latency(self):
+        """
+        :return: the time, in seconds, between capture and the most recently marked stage
+        """
+        if not self.stages:
+            return 0.0
+
+        return self.stages[-1][1] - self.capture_time
+
+    @property
+    def processing_time(self):
+        """
+        :return: the time, in seconds, between the ``start`` stage and the most recently marked stage; without a
+                 ``start`` stage, the same as :attr:`latency`
+        """
+        if not self.stages:
+            return 0.0
+
+        start = self.capture_time
+        for stage, time, thread in self.stages:
+            if stage == 'start':
+                start = time
+                break
+
+        return self.stages[-1][1] - start
+
+    def spans(self):
+        """
+        :return: a list of (stage, start, end, thread name) tuples, where each stage starts when the previous one ended
+        """
+        spans = []
+
+        start = self.capture_time
+        for stage, end, thread in self.stages:
+            spans.append((stage, start, end, thread))
+            start = end
+
+        return spans
+
+
+class LatencyStats:
+    """
+    A rolling window of end-to-end latencies for a single camera.
+    """
+
+    def __init__(self, window = LATENCY_WINDOW):
+        self.latencies = deque(maxlen = window)
+
+    def add(self, trace):
+        """
+        Adds a completed trace to the window.
+
+        :param trace: a :class:`FrameTrace`, which should already be marked as received
+        """
+        self.latencies.append(trace.latency)
+
+    def percentiles(self, q = (50, 90, 99)):
+        """
+        :param q: a sequence of percentiles to compute
+        :return: a list of latencies in seconds, one per percentile, or None if no frames have been recorded
+        """
+        if not self.latencies:
+            return None
+
+        return list(np.percentile(list(self.latencies), q))
+
+
+class TraceRecorder:
+    """
+    Collects frame traces and exports them in the Chrome trace-event (JSON) format, with one row per processing
+    thread. Only the most recent ``max_traces`` traces are kept.
+    """
+
+    def __init__(self, max_traces = 10000):
+        self.traces = deque(maxlen = max_traces)
+
+    def add(self, trace):
+        self.traces.append(trace)
+
+    def events(self):
+        """
+        :return: a list of trace-event dicts with timestamps in microseconds
+        """
+        events = []
+
+        for trace in list(self.traces):
+            for stage, start, end, thread in trace.spans():
+                events.append({
+                    'name': stage,
+                    'cat': trace.camera,
+                    'ph': 'X',
+                    'ts': start * 1e6,
+                    'dur': (end - start) * 1e6,
+                    'pid': 1,
+                    'tid': thread,
+                    'args': {'camera': trace.camera, 'frame': trace.frame_count}
+                })
+
+        return events
+
+    def save(self, path):
+        """
+        Writes the recorded traces to a JSON file.
+
+        :param path: the output file path
+        """
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': self.events(), 'displayTimeUnit': 'ms'}, f)
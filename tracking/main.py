@@ -1,22 +1,79 @@
 import cv2
 
+from collections import namedtuple
 from Queue import Queue
 from threading import Thread
 
-from vision import preprocess, find_edges, find_circles
+from detector import ContourDetector, CachingDetector
+from latency import FrameTrace, LatencyStats, TraceRecorder, read_frame
+from vision import FrameBuffers
 from point import find_points
 from cluster import find_clusters
+from render import RenderWorker, draw_frame
+from scheduler import CoreScheduler
+
+
+#: The results of processing a single frame. ``frame`` is the preprocessed frame, ``points`` and ``clusters`` the
+#: tracking state after the frame, and ``trace`` its :class:`tracking.latency.FrameTrace`.
+FrameResult = namedtuple('FrameResult', 'name frame_count frame points clusters trace')
 
 
 class TrackingThread(Thread):
 
-    def __init__(self, camera_id, name):
+    def __init__(self, camera_id, name, detector = None, candidates = None, pose_solver = None, calibration = None,
+                 flow = None, motion = None, governor = None, scheduler = None):
+        """
+        :param camera_id: a camera index or video file, passed to ``cv2.VideoCapture``, or an object with a compatible
+                          ``read()`` method such as a :class:`tracking.capture.CameraChannel`; None if frames will only
+                          be passed in directly
+        :param name: a display name for this camera
+        :param detector: the :class:`tracking.detector.Detector` used to find circles, by default a
+                         :class:`tracking.detector.ContourDetector`
+        :param candidates: an optional :class:`tracking.point.CandidatePool` used to hold back unconfirmed detections
+        :param pose_solver: an optional :class:`tracking.pose.PoseSolver` for this camera, used to solve the pose of
+                            each 3-point cluster
+        :param calibration: an optional :class:`tracking.calibration.Calibration` used to undistort detected circles
+        :param flow: an optional :class:`tracking.flow.FlowTracker`; if given, full detection only runs at an adaptive
+                     interval, and points are tracked with optical flow in between
+        :param motion: an optional :class:`tracking.motion.MotionGate`; if given, detection is restricted to regions
+                       that changed since the previous frame
+        :param governor: an optional :class:`tracking.governor.QualityGovernor`, which adjusts processing cost to hold
+                         a target frame rate
+        :param scheduler: an optional :class:`tracking.scheduler.CoreScheduler`; when started, this thread is pinned
+                          to the cores budgeted for its name
+        """
         super(TrackingThread, self).__init__()
 
+        if detector is None:
+            detector = ContourDetector()
+
+        self.detector = detector
+        self.candidates = candidates
+        self.pose_solver = pose_solver
+        self.calibration = calibration
+        self.flow = flow
+        self.motion = motion
+        self.governor = governor
+        self.scheduler = scheduler
+        self.buffers = FrameBuffers()
+
+        # used by process_dummy() to skip detection of repeated frames
+        self.dummy_detector = None
+
+        # points not examined by detect() for the current frame, which keep their state, see find_points()
+        self.held = []
+
         self.frames = Queue(maxsize = 1)
 
-        # noinspection PyArgumentList
-        self.capture = cv2.VideoCapture(camera_id)
+        if camera_id is None:
+            # only driven directly, e.g. by tracking.pipeline.Pipeline
+            self.capture = None
+        elif hasattr(camera_id, 'read'):
+            # e.g. a tracking.capture.CameraChannel
+            self.capture = camera_id
+        else:
+            # noinspection PyArgumentList
+            self.capture = cv2.VideoCapture(camera_id)
         self.name = name
 
         self.frame_count = 0
@@ -25,20 +82,105 @@ class TrackingThread(Thread):
         self.points = []
         self.clusters = []
 
-    def process(self, frame):
+        #: keyword arguments for :func:`tracking.cluster.find_clusters`
+        self.cluster_options = {'max_length': 3}
+
+        #: end-to-end latencies, updated by the consumer of ``self.frames``
+        self.latency = LatencyStats()
+
+    def process(self, frame, capture_time = None):
         """
         Processes a single frame, and outputs the results to ``self.frames``. Note that this may block if the frame
         queue is full.
 
         :param frame: the frame to process
+        :param capture_time: the monotonic time at which the frame was captured, by default now
+        """
+        self.frames.put(self.step(frame, capture_time))
+
+    def step(self, frame, capture_time = None):
+        """
+        Processes a single frame, and returns the results directly rather than through ``self.frames``.
+
+        :param frame: the frame to process
+        :param capture_time: the monotonic time at which the frame was captured, by default now
+        :return: a :class:`FrameResult`
+        """
+        trace = FrameTrace(self.name, self.frame_count, capture_time)
+        trace.mark('start')
+
+        frame, circles = self.detect(frame, trace)
+
+        return self.step_circles(frame, circles, trace)
+
+    def detect(self, frame, trace):
+        """
+        Runs the vision stages on a single frame: full detection, or optical flow or motion-gated detection if
+        configured.
+
+        :param frame: the raw frame
+        :param trace: the frame's :class:`tracking.latency.FrameTrace`
+        :return: a (preprocessed frame, circles) tuple
+        """
+        if self.flow is not None and not self.flow.should_detect(self.points):
+            frame = self.detector.preprocess(frame, self.buffers)
+            circles = self.flow.track(frame, self.points, self.frame_count)
+            self.held = self.flow.held
+            trace.mark('flow')
+
+            return frame, circles
+
+        if self.motion is not None:
+            frame = self.detector.preprocess(frame, self.buffers)
+
+            # static points are carried over rather than re-detected
+            regions, circles = self.motion.update(frame, self.points, self.frame_count)
+            if regions is None:
+                circles = self.detector.detect(frame, self.frame_count, self.buffers)
+            else:
+                circles.extend(self.detector.detect_regions(frame, self.frame_count, regions))
+        else:
+            frame, circles = self.detector.process(frame, self.frame_count, self.buffers)
+
+        trace.mark('detect')
+
+        if self.flow is not None:
+            self.flow.detected(frame)
+
+        return frame, circles
+
+    def track(self, frame, circles, trace = None):
+        """
+        Runs point and cluster tracking against circles already detected in the given (preprocessed) frame, and
+        outputs the results to ``self.frames``. This is the second half of :meth:`process`, used directly when
+        detection happens elsewhere (see :class:`tracking.batch.BatchedTracker`).
+
+        :param frame: the preprocessed frame
+        :param circles: a list of :class:`tracking.vision.Circle` instances found in the frame
+        :param trace: the frame's :class:`tracking.latency.FrameTrace`, if any
         """
-        frame = preprocess(frame)
+        self.frames.put(self.step_circles(frame, circles, trace))
 
-        edges = find_edges(frame)
-        circles = find_circles(frame, self.frame_count, edges)
+    def step_circles(self, frame, circles, trace = None):
+        """
+        Runs point and cluster tracking like :meth:`track`, but returns the results directly.
+
+        :param frame: the preprocessed frame
+        :param circles: a list of :class:`tracking.vision.Circle` instances found in the frame
+        :param trace: the frame's :class:`tracking.latency.FrameTrace`, if any
+        :return: a :class:`FrameResult`
+        """
+        if trace is None:
+            trace = FrameTrace(self.name, self.frame_count)
+
+        if self.calibration is not None:
+            self.calibration.undistort_circles(circles)
+            trace.mark('undistort')
 
-        points = find_points(circles, self.points, self.frame_count)
+        points = find_points(circles, self.points, self.frame_count, self.candidates, self.held)
         self.points = points
+        self.held = []
+        trace.mark('points')
 
         acceptable = filter(lambda p: p.quality > 0.25, self.points)
 
@@ -52,38 +194,60 @@ class TrackingThread(Thread):
         for cluster in dead_clusters:
             self.clusters.remove(cluster)
 
-        clusters = find_clusters(acceptable, self.clusters, max_length = 3)
+        clusters = find_clusters(acceptable, self.clusters, **self.cluster_options)
         self.clusters = clusters
+        trace.mark('clusters')
+
+        if self.pose_solver is not None:
+            self.pose_solver.solve(clusters)
+            trace.mark('pose')
+
+        if self.governor is not None:
+            self.governor.update(self, trace)
 
         self.frame_count += 1
 
-        self.frames.put((self.name, self.frame_count, frame, points, clusters))
+        return FrameResult(self.name, self.frame_count, frame, points, clusters, trace)
 
     def get_frame(self):
         """
         Gets the frame in the queue. This is equivalent to `self.frames.get()`.
 
-        :return: name, frame_count, frame, points, clusters
+        :return: a :class:`FrameResult`
         """
         return self.frames.get()
 
     def process_dummy(self, frame, iterations = 1):
         last = None
 
-        for i in range(iterations):
-            self.process(frame)
-            last = self.get_frame()
+        # the same frame is processed repeatedly, so detection only needs to run once
+        detector = self.detector
+        if not isinstance(detector, CachingDetector):
+            if self.dummy_detector is None or self.dummy_detector.detector is not detector:
+                self.dummy_detector = CachingDetector(detector, size = 1)
+
+            self.detector = self.dummy_detector
+
+        try:
+            for i in range(iterations):
+                self.process(frame)
+                last = self.get_frame()
+        finally:
+            self.detector = detector
 
         return last
 
     def run(self):
         self.running = True
 
+        if self.scheduler is not None:
+            self.scheduler.enter(self.name)
+
         while self.running:
-            ret, frame = self.capture.read()
+            frame, capture_time = read_frame(self.capture)
 
             if frame is not None:
-                self.process(frame)
+                self.process(frame, capture_time)
             else:
                 print "reached end of stream"
                 break
@@ -93,29 +257,10 @@ class TrackingThread(Thread):
 
 
 def draw_image(frame_count, frame, points, clusters):
-    dest = frame.copy()
-
-    #for point in points:
-    #    point.draw(dest, frame_count)
-
-    for cluster in clusters:
-        cluster.draw(dest)
-
-    #for cluster, center in clusters:
-    #    for point in cluster:
-    #        cv2.line(dest, point.pos, center.pos, (0, 255, 0), 1)
-
-    #    cv2.circle(dest, center.pos, 4, (255, 255, 255), 2)
-
-    cv2.putText(dest, "Frame #%d" % frame_count,
-                (10, 470),
-                cv2.FONT_HERSHEY_SIMPLEX, 0.4,
-                (255, 255, 255), lineType = cv2.LINE_AA)
+    return draw_frame(frame.copy(), frame_count, [cluster.overlay() for cluster in clusters])
 
-    return dest
 
-
-def show_camera((name, frame_count, frame, points, clusters)):
+def show_camera((name, frame_count, frame, points, clusters, trace)):
     """
     Displays the output for a particular :class:`TrackingThread` instance into a named window.
     """
@@ -144,7 +289,23 @@ def show_dummy(thread, frame, iterations = 1):
         cv2.waitKey(1) # wat
 
 
-def main():
+def main(trace_path = None, publisher = None, budget = None):
+    """
+    Runs tracking on all configured cameras, rendering the output to ``render.ogv``.
+
+    :param trace_path: if set, a Chrome trace-event file to write frame timings to on exit
+    :param publisher: an optional :class:`tracking.publish.Publisher` or :class:`tracking.shm.SharedMemoryWriter` to
+                      export results to other processes; cameras are identified by their index in the thread list
+    :param budget: if set, the number of cores to use: rendering is given one of them, camera threads share the rest,
+                   and every thread is pinned to its share (see :class:`tracking.scheduler.CoreScheduler`); 0 uses all
+                   available cores. Otherwise, threads are left to the operating system
+    """
+    recorder = None
+    if trace_path:
+        recorder = TraceRecorder()
+
+    # no CandidatePool is used: it delays every new point by CANDIDATE_SIGHTINGS frames, which only pays off for noisy
+    # cameras; give such a thread its own pool with candidates = CandidatePool()
     threads = [
         TrackingThread("clusters.ogv", "clusters.ogv")
         #TrackingThread(0, "Center"),
@@ -152,18 +313,35 @@ def main():
         #TrackingThread(2, "Left")
     ]
 
+    scheduler = None
+    if budget is not None:
+        scheduler = CoreScheduler(budget or None, stages = {'render': 1}, workers = [t.name for t in threads])
+
     for thread in threads:
+        thread.scheduler = scheduler
         thread.start()
 
     output = cv2.VideoWriter("render.ogv", cv2.VideoWriter_fourcc('T', 'H', 'E', 'O'), 30, (1440, 810), True)
 
+    # rendering and encoding happen off the consumer loop, dropping frames if they fall behind
+    renderer = RenderWorker(output, scheduler = scheduler)
+    renderer.start()
+
     while True:
-        for thread in threads:
+        for camera, thread in enumerate(threads):
             #show_camera(thread.frames.get())
 
-            name, frame_count, frame, points, clusters = thread.frames.get()
+            name, frame_count, frame, points, clusters, trace = thread.frames.get()
+            trace.mark('received')
+
+            thread.latency.add(trace)
+            if recorder:
+                recorder.add(trace)
+
+            if publisher:
+                publisher.publish(camera, frame_count, trace.capture_time, points, clusters)
 
-            output.write(draw_image(frame_count, frame, points, clusters))
+            renderer.submit(frame_count, frame, clusters)
 
         if cv2.waitKey(1) & 0xFF == ord('q'):
             break
@@ -172,14 +350,30 @@ def main():
         thread.running = False
         thread.frames.get()
 
+    renderer.stop()
+    output.release()
+
+    print "rendered %d frames, dropped %d" % (renderer.rendered, renderer.dropped)
+
+    if scheduler is not None:
+        print scheduler.format_report()
+
+    for thread in threads:
+        latencies = thread.latency.percentiles()
+        if latencies:
+            print "%s latency (ms): p50 %.1f, p90 %.1f, p99 %.1f" % ((thread.name,) + tuple(l * 1000 for l in latencies))
+
+    if recorder:
+        recorder.save(trace_path)
+
     cv2.destroyAllWindows()
 
 
 if __name__ == '__main__':
-    import yappi
-    yappi.start()
+    from profiling import ProfilerControl
 
-    main()
+    # kill -USR1 toggles profiling, kill -USR2 writes a memory report
+    ProfilerControl().install()
 
-    yappi.get_func_stats().save('yappi.cg', type = 'callgrind')
+    main()
 
@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+"""
+Motion-mask gating of the vision stages.
+
+Much of each frame (the desk, the static background) does not change between frames. A :class:`MotionGate` computes
+a temporal difference on a downscaled grayscale copy of each frame, and restricts edge detection and contour analysis
+to the changed regions plus the neighborhoods of moving and unconfirmed points. Confirmed, stationary points in
+unchanged regions keep their existing state without being re-detected, while unconfirmed ones (e.g. noise) must be
+re-detected like any other point, and otherwise expire as usual.
+
+Regions are computed on the frame as captured, so point positions are compared in image space (see
+:attr:`tracking.point.Point.raw_pos`), before any undistortion.
+"""
+
+import cv2
+import numpy as np
+
+from vision import Circle
+
+#
+# Tunables
+#
+
+#: The downscaling factor of the difference image
+MOTION_SCALE = 4
+
+#: The minimum per-pixel intensity change (0 - 255) considered motion
+MOTION_THRESHOLD = 12
+
+#: Dilation iterations applied to the (downscaled) motion mask
+MOTION_DILATION = 2
+
+#: The size, in full-resolution pixels, of the neighborhood added around each moving point
+POINT_MARGIN = 32
+
+#: Velocities, in pixels per frame, below which a point is considered stationary
+STATIC_VELOCITY = 0.5
+
+#: If more than this fraction of the frame changed, the whole frame is processed instead
+MAX_CHANGED_FRACTION = 0.5
+
+#: The minimum :attr:`tracking.point.Point.quality` of a static point to be carried forward without re-detection
+CARRY_QUALITY = 0.25
+
+#
+# End of tunables
+#
+
+kernel = np.ones((3, 3), np.uint8)
+
+
+def merge_rects(rects):
+    """
+    Merges overlapping rectangles until none overlap.
+
+    :param rects: a list of (x, y, width, height) rectangles
+    :return: a list of non-overlapping rectangles covering the input
+    """
+    boxes = [[x, y, x + w, y + h] for x, y, w, h in rects]
+
+    merged = True
+    while merged:
+        merged = False
+
+        for i in range(len(boxes)):
+            for j in range(i + 1, len(boxes)):
+                a, b = boxes[i], boxes[j]
+                if a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]:
+                    boxes[i] = [min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3])]
+                    del boxes[j]
+
+                    merged = True
+                    break
+
+            if merged:
+                break
+
+    return [(x0, y0, x1 - x0, y1 - y0) for x0, y0, x1, y1 in boxes]
+
+
+class MotionGate:
+    """
+    Tracks frame-to-frame changes for a single camera. Used by :class:`tracking.main.TrackingThread` when given as its
+    ``motion`` argument.
+    """
+
+    def __init__(self, scale = MOTION_SCALE, threshold = MOTION_THRESHOLD):
+        self.scale = scale
+        self.threshold = threshold
+
+        self.previous = None
+
+        #: the fraction of the frame that changed on the most recent update
+        self.changed = 1.0
+
+    def update(self, frame, points, frame_count):
+        """
+        Compares the given frame against the previous one.
+
+        :param frame: the preprocessed BGR frame
+        :param points: the currently known points
+        :param frame_count: the current frame number
+        :return: a (regions, circles) tuple: a list of (x, y, width, height) regions to run detection in, or None if
+                 the whole frame should be processed, and a list of synthetic
+                 :class:`tracking.vision.Circle` instances, in image space, for confirmed points outside of those
+                 regions
+        """
+        height, width = frame.shape[:2]
+        size = (width // self.scale, height // self.scale)
+
+        small = cv2.cvtColor(cv2.resize(frame, size, interpolation = cv2.INTER_AREA), cv2.COLOR_BGR2GRAY)
+        previous, self.previous = self.previous, small
+
+        if previous is None:
+            self.changed = 1.0
+            return None, []
+
+        diff = cv2.absdiff(small, previous)
+        _, mask = cv2.threshold(diff, self.threshold, 255, cv2.THRESH_BINARY)
+        mask = cv2.dilate(mask, kernel, iterations = MOTION_DILATION)
+
+        # include neighborhoods of moving points, so their next positions are searched even where the difference is
+        # faint, and of unconfirmed points, which are never carried forward
+        margin = POINT_MARGIN // self.scale
+        for point in points:
+            if abs(point.x_velocity_mean) > STATIC_VELOCITY or abs(point.y_velocity_mean) > STATIC_VELOCITY or \
+                    point.quality <= CARRY_QUALITY:
+                x, y = point.raw_pos
+                x, y = int(x) // self.scale, int(y) // self.scale
+                cv2.rectangle(mask, (x - margin, y - margin), (x + margin, y + margin), 255, -1)
+
+        self.changed = np.count_nonzero(mask) / float(mask.size)
+        if self.changed > MAX_CHANGED_FRACTION:
+            return None, []
+
+        _, contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+        regions = merge_rects([tuple(v * self.scale for v in cv2.boundingRect(c)) for c in contours])
+
+        # confirmed points outside of every region are static, and keep their state; unconfirmed points are never kept
+        # alive without being detected
+        static = []
+        for point in points:
+            if point.quality <= CARRY_QUALITY:
+                continue
+
+            x, y = point.raw_pos
+            if not any(rx <= x < rx + rw and ry <= y < ry + rh for rx, ry, rw, rh in regions):
+                static.append(Circle.from_point(point, frame_count, x, y))
+
+        return regions, static
@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+"""
+A generator API for using the tracker as a library.
+
+A :class:`Pipeline` consumes any iterable of frames and lazily yields a :class:`tracking.main.FrameResult` per frame,
+without the thread and queue of a :class:`tracking.main.TrackingThread`. For example::
+
+    from pipeline import Pipeline, read_frames
+    from recording import RawFrameSource
+
+    for result in Pipeline().run(read_frames(RawFrameSource('session.raw'))):
+        print result.frame_count, len(result.clusters)
+
+Only one frame is processed at a time, so long recordings use constant memory. Results are not independent copies:
+``frame`` is one of a small ring of reused buffers, and points and clusters continue to be updated by later frames,
+so copy anything that needs to outlive the next couple of results.
+
+Stage hooks can observe or modify intermediate results:
+
+ - ``frame(frame)``: called with each raw frame; returns the frame to process
+ - ``circles(frame, circles)``: called after detection with the preprocessed frame; returns the circles to track
+ - ``result(result)``: called with each result; returns the result to yield, or None to skip it
+"""
+
+from Queue import Queue, Full
+from threading import Event, Thread
+
+from latency import FrameTrace, read_frame
+from main import TrackingThread
+
+#: The number of frames read ahead in threaded mode
+PREFETCH_FRAMES = 2
+
+#: How often, in seconds, a reader waiting for space checks whether the consumer has stopped
+PUT_TIMEOUT = 0.1
+
+HOOKS = ('frame', 'circles', 'result')
+
+# marks the end of the input in threaded mode
+_END = object()
+
+
+def read_frames(capture):
+    """
+    Reads frames from a capture until the end of its stream.
+
+    :param capture: a ``cv2.VideoCapture``, or an object with a compatible ``read()`` method such as a
+                    :class:`tracking.recording.RawFrameSource`; see :func:`tracking.latency.read_frame` for how frames
+                    are stamped
+    :return: a generator of (frame, capture time) tuples
+    """
+    while True:
+        frame, capture_time = read_frame(capture)
+        if frame is None:
+            break
+
+        yield frame, capture_time
+
+
+def _prefetch(frames, size):
+    """
+    Iterates over frames on a background thread, keeping up to ``size`` frames ready. The thread stops once the
+    consumer does, e.g. on ``break``, ``close()`` or an exception.
+    """
+    queue = Queue(maxsize = size)
+    stopped = Event()
+
+    def put(item):
+        # waits for space, unless the consumer has gone
+        while not stopped.is_set():
+            try:
+                queue.put(item, timeout = PUT_TIMEOUT)
+                return True
+            except Full:
+                pass
+
+        return False
+
+    def produce():
+        try:
+            for item in frames:
+                if not put((item, None)):
+                    return
+        except Exception as e:
+            put((_END, e))
+        else:
+            put((_END, None))
+
+    thread = Thread(target = produce, name = 'pipeline-reader')
+    thread.daemon = True
+    thread.start()
+
+    try:
+        while True:
+            item, error = queue.get()
+            if item is _END:
+                if error is not None:
+                    raise error
+
+                return
+
+            yield item
+    finally:
+        stopped.set()
+
+
+class Pipeline:
+    """
+    Tracks a single camera's frames. Keyword arguments are passed to :class:`tracking.main.TrackingThread`, e.g. a
+    ``detector``, ``flow`` tracker or ``pose_solver``.
+    """
+
+    def __init__(self, name = 'pipeline', hooks = None, **options):
+        """
+        :param name: the camera name used in results
+        :param hooks: a dict of stage name to hook function; see the module documentation
+        :param options: tracking options, see :class:`tracking.main.TrackingThread`
+        """
+        hooks = dict(hooks or {})
+        for stage in hooks:
+            if stage not in HOOKS:
+                raise ValueError("unknown pipeline stage: %s" % stage)
+
+        self.hooks = hooks
+
+        #: the underlying tracker, which holds all tracking state; it is never started as a thread
+        self.tracker = TrackingThread(None, name, **options)
+
+    def step(self, frame, capture_time = None):
+        """
+        Processes a single frame.
+
+        :param frame: the raw BGR frame
+        :param capture_time: the monotonic time at which the frame was captured, by default now
+        :return: a :class:`tracking.main.FrameResult`, or None if skipped by a hook
+        """
+        hooks = self.hooks
+
+        if 'frame' in hooks:
+            frame = hooks['frame'](frame)
+
+        trace = FrameTrace(self.tracker.name, self.tracker.frame_count, capture_time)
+        trace.mark('start')
+
+        frame, circles = self.tracker.detect(frame, trace)
+
+        if 'circles' in hooks:
+            circles = hooks['circles'](frame, circles)
+
+        result = self.tracker.step_circles(frame, circles, trace)
+
+        if 'result' in hooks:
+            result = hooks['result'](result)
+
+        return result
+
+    def run(self, frames, threaded = False, prefetch = PREFETCH_FRAMES):
+        """
+        Lazily processes frames, yielding one result per frame.
+
+        :param frames: an iterable of raw frames, or of (frame, capture time) tuples such as from :func:`read_frames`
+        :param threaded: if True, frames are read ahead on a background thread, overlapping e.g. decoding with
+                         tracking; otherwise no threads are used
+        :param prefetch: the number of frames read ahead in threaded mode
+        :return: a generator of :class:`tracking.main.FrameResult` instances
+        """
+        if threaded:
+            frames = _prefetch(frames, prefetch)
+
+        for item in frames:
+            if isinstance(item, tuple):
+                frame, capture_time = item
+            else:
+                frame, capture_time = item, None
+
+            result = self.step(frame, capture_time)
+            if result is not None:
+                yield result
@@ -44,6 +44,12 @@ BOUNDS_MULTIPLIER = 20
 #: An angle of rotation for search area upper and lower bounds.
 ROTATION_THETA = np.pi / 6
 
+#: The number of consistent sightings before a candidate is promoted to a Point (see :class:`CandidatePool`)
+CANDIDATE_SIGHTINGS = 3
+
+#: The number of frames a candidate may go unseen before it is discarded
+CANDIDATE_TIMEOUT = 2
+
 #
 # End of tunables
 #
@@ -61,11 +67,13 @@ ROTATION_CW = np.mat([
 point_index = 0
 
 
-class SimplePoint:
+class SimplePoint(object):
     """
     A simple point class with only basic functionality for position, distance, and midpoint calculation.
     """
 
+    __slots__ = ('x', 'y')
+
     def __init__(self, x, y):
         self.x = x
         self.y = y
@@ -381,6 +389,17 @@ class Point:
     def y(self):
         return int(self.y_window_mean)
 
+    @property
+    def raw_pos(self):
+        """
+        :return: the most recent (x, y) position in image space, i.e. before any undistortion, as floats
+        """
+        last = self.circle_history[-1]
+        if last.raw is not None:
+            return last.raw
+
+        return float(last.x), float(last.y)
+
     @property
     def last_x(self):
         return int(self.x_window[-1])
@@ -416,7 +435,100 @@ class Point:
             return None
 
 
-def find_points(circles, points, frame_count):
+class CandidatePool(object):
+    """
+    A probation pool for unconfirmed detections. Circles that could not be paired with a known :class:`Point` are kept
+    here in compact arrays, and are only promoted to full points once they have been seen in
+    :data:`.CANDIDATE_SIGHTINGS` consistent frames. Noise contours then expire from the pool without ever entering the
+    (much more expensive) point matching in :func:`find_points`.
+
+    The pool is opt-in: every new point, real or not, appears :data:`.CANDIDATE_SIGHTINGS` frames later, so it only
+    pays off for cameras that see many short-lived noise contours.
+    """
+
+    def __init__(self, sightings = CANDIDATE_SIGHTINGS, timeout = CANDIDATE_TIMEOUT, max_distance = MAX_DISTANCE):
+        self.sightings = sightings
+        self.timeout = timeout
+        self.max_distance = max_distance
+
+        self.x = np.empty(0)
+        self.y = np.empty(0)
+        self.last_frame = np.empty(0, dtype = int)
+        self.hits = np.empty(0, dtype = int)
+
+        # per-candidate circle histories, used to seed promoted points
+        self.histories = []
+
+    def __len__(self):
+        return len(self.histories)
+
+    def _keep(self, mask):
+        self.x = self.x[mask]
+        self.y = self.y[mask]
+        self.last_frame = self.last_frame[mask]
+        self.hits = self.hits[mask]
+        self.histories = [h for h, keep in zip(self.histories, mask) if keep]
+
+    def update(self, circles, frame_count):
+        """
+        Matches the given circles against known candidates, adds any unmatched circles as new candidates, and removes
+        candidates that have been promoted or have timed out.
+
+        :param circles: a list of circles not paired with any known point
+        :param frame_count: the current frame number
+        :return: a list of circle histories (lists of circles, oldest first) for promoted candidates
+        """
+        if len(self.histories):
+            self._keep(frame_count - self.last_frame <= self.timeout)
+
+        cx = np.array([c.x for c in circles], dtype = float)
+        cy = np.array([c.y for c in circles], dtype = float)
+
+        paired_circles = np.zeros(len(circles), dtype = bool)
+
+        if len(circles) and len(self.histories):
+            # squared distances, circles x candidates
+            distances = (cx[:, None] - self.x[None, :])**2 + (cy[:, None] - self.y[None, :])**2
+
+            # pair in order of globally minimum distance, as in find_points()
+            paired_candidates = np.zeros(len(self.histories), dtype = bool)
+            for index in np.argsort(distances, axis = None):
+                ci, pi = np.unravel_index(index, distances.shape)
+                if distances[ci, pi] >= self.max_distance:
+                    break
+
+                if paired_circles[ci] or paired_candidates[pi]:
+                    continue
+
+                paired_circles[ci] = True
+                paired_candidates[pi] = True
+
+                self.x[pi] = cx[ci]
+                self.y[pi] = cy[ci]
+                self.last_frame[pi] = frame_count
+                self.hits[pi] += 1
+                self.histories[pi].append(circles[ci])
+
+        new = ~paired_circles
+        if new.any():
+            count = np.count_nonzero(new)
+            self.x = np.concatenate((self.x, cx[new]))
+            self.y = np.concatenate((self.y, cy[new]))
+            self.last_frame = np.concatenate((self.last_frame, np.repeat(frame_count, count)))
+            self.hits = np.concatenate((self.hits, np.ones(count, dtype = int)))
+            self.histories.extend([c] for c, is_new in zip(circles, new) if is_new)
+
+        promoted = self.hits >= self.sightings
+        if not promoted.any():
+            return []
+
+        histories = [h for h, p in zip(self.histories, promoted) if p]
+        self._keep(~promoted)
+
+        return histories
+
+
+def find_points(circles, points, frame_count, candidates = None, held = ()):
     """
     Given a list of Circle instances, creates or updates Point instances. The
     passed list of known Point objects will be modified.
@@ -424,6 +536,10 @@ def find_points(circles, points, frame_count):
     :param circles: a list of circles
     :param points: a list of previously known points
     :param frame_count: the current frame number
+    :param candidates: an optional :class:`CandidatePool`; if given, unpaired circles only become points once promoted
+                       from the pool, otherwise each unpaired circle immediately becomes a new point
+    :param held: points that keep their state if unpaired, rather than decaying, e.g. those skipped by
+                 :class:`tracking.flow.FlowTracker`
     :return:
     """
     # attempt to pair points with a globally minimum-distance contour
@@ -457,13 +573,22 @@ def find_points(circles, points, frame_count):
 
     # the remaining circles are previously unknown
     remaining_circles = [c for c in circles if c not in paired_circles]
-    for circle in remaining_circles:
-        p = Point(circle)
-        points.append(p)
+    if candidates is None:
+        for circle in remaining_circles:
+            p = Point(circle)
+            points.append(p)
+    else:
+        for history in candidates.update(remaining_circles, frame_count):
+            p = Point(history[0])
+            for circle in history[1:]:
+                p.update(circle)
+
+            points.append(p)
 
     # iterate again to find all remaining points and "empty" update them
+    held = set(held)
     for point in points:
-        if point.last_frame != frame_count:
+        if point.last_frame != frame_count and point not in held:
             point.update_empty(frame_count)
 
     return points
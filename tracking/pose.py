@@ -0,0 +1,327 @@
+# -*- coding: utf-8 -*-
+"""
+Batched 6-DoF pose estimation for 3-point clusters.
+
+Each live 3-point :class:`tracking.cluster.Cluster` is treated as an equilateral triangle marker of known size
+(:data:`.MARKER_SIDE`). Given per-camera intrinsics, the orientation (as a Rodrigues rotation vector) and position of
+every marker are solved together: all clusters are stacked into arrays and refined with a vectorized
+Levenberg-Marquardt iteration, so the cost of each step is a handful of NumPy operations regardless of the number of
+clusters.
+
+The previous frame's pose is used as a warm start where a cluster's members are unchanged, which typically converges
+in one or two iterations.
+"""
+
+import numpy as np
+
+from timeit import default_timer
+
+#
+# Tunables
+#
+
+#: The side length of the physical marker triangle; poses are reported in the same units
+MARKER_SIDE = 3.0
+
+#: The horizontal field of view assumed by :meth:`CameraIntrinsics.from_fov`, in radians
+DEFAULT_FOV = np.radians(75)
+
+#: The maximum number of Levenberg-Marquardt iterations per solve
+MAX_ITERATIONS = 15
+
+#: Iteration stops once every cluster's RMS reprojection error, in pixels, is below this value
+CONVERGED_ERROR = 0.05
+
+#
+# End of tunables
+#
+
+# finite difference step for the numerical Jacobian
+EPSILON = 1e-6
+
+
+class CameraIntrinsics:
+    """
+    Pinhole camera intrinsics: focal lengths and principal point, in pixels.
+    """
+
+    def __init__(self, fx, fy, cx, cy):
+        self.fx = fx
+        self.fy = fy
+        self.cx = cx
+        self.cy = cy
+
+    @classmethod
+    def from_fov(cls, width, height, fov = DEFAULT_FOV):
+        """
+        Approximates intrinsics for an uncalibrated camera from its resolution and horizontal field of view.
+
+        :param width: the image width in pixels
+        :param height: the image height in pixels
+        :param fov: the horizontal field of view, in radians
+        """
+        f = (width / 2.0) / np.tan(fov / 2.0)
+
+        return cls(f, f, width / 2.0, height / 2.0)
+
+    @property
+    def matrix(self):
+        """
+        :return: the 3x3 camera matrix
+        """
+        return np.array([
+            [self.fx, 0, self.cx],
+            [0, self.fy, self.cy],
+            [0, 0, 1]
+        ], dtype = float)
+
+
+class Pose(object):
+    """
+    The solved pose of a single marker, in camera coordinates (x right, y down, z forward).
+    """
+
+    __slots__ = ('rvec', 'tvec', 'error', 'members', 'mirrored')
+
+    def __init__(self, rvec, tvec, error, members, mirrored):
+        self.rvec = rvec
+        self.tvec = tvec
+        self.error = error
+        self.members = members
+        self.mirrored = mirrored
+
+    @property
+    def rotation(self):
+        """
+        :return: the 3x3 rotation matrix
+        """
+        return rodrigues(self.rvec[None, :])[0]
+
+    @property
+    def normal(self):
+        """
+        :return: the marker's surface normal, as a unit vector
+        """
+        return self.rotation[:, 2]
+
+
+def marker_model(side = MARKER_SIDE):
+    """
+    :param side: the triangle side length
+    :return: a 3x3 array of the marker vertices, centered at the origin in the z = 0 plane, counter-clockwise
+    """
+    r = side / np.sqrt(3)
+    angles = np.pi / 2 + np.array([0, 2, 4]) * np.pi / 3
+
+    return np.column_stack((r * np.cos(angles), r * np.sin(angles), np.zeros(3)))
+
+
+def rodrigues(rvecs):
+    """
+    Converts rotation vectors to rotation matrices.
+
+    :param rvecs: an n x 3 array of rotation vectors
+    :return: an n x 3 x 3 array of rotation matrices
+    """
+    theta = np.sqrt((rvecs**2).sum(axis = 1))
+    small = theta < 1e-12
+
+    k = rvecs / np.where(small, 1.0, theta)[:, None]
+    kx, ky, kz = k[:, 0], k[:, 1], k[:, 2]
+    zero = np.zeros_like(kx)
+
+    K = np.stack((
+        np.stack((zero, -kz, ky), axis = 1),
+        np.stack((kz, zero, -kx), axis = 1),
+        np.stack((-ky, kx, zero), axis = 1)
+    ), axis = 1)
+
+    sin = np.sin(theta)[:, None, None]
+    cos = np.cos(theta)[:, None, None]
+
+    return np.eye(3)[None, :, :] + sin * K + (1 - cos) * np.matmul(K, K)
+
+
+def project(params, models, intrinsics):
+    """
+    Projects each marker's model points into the image.
+
+    :param params: an n x 6 array of (rvec, tvec) parameters
+    :param models: an n x 3 x 3 array of model points
+    :param intrinsics: a :class:`CameraIntrinsics` instance
+    :return: an n x 3 x 2 array of image points
+    """
+    R = rodrigues(params[:, :3])
+    camera = np.matmul(models, R.transpose(0, 2, 1)) + params[:, None, 3:]
+
+    z = camera[:, :, 2]
+    z = np.where(np.abs(z) < 1e-9, 1e-9, z)
+
+    u = intrinsics.fx * camera[:, :, 0] / z + intrinsics.cx
+    v = intrinsics.fy * camera[:, :, 1] / z + intrinsics.cy
+
+    return np.stack((u, v), axis = 2)
+
+
+def signed_area(triangles):
+    """
+    :param triangles: an n x 3 x 2 array of triangle vertices
+    :return: an array of twice the signed triangle areas
+    """
+    a = triangles[:, 1] - triangles[:, 0]
+    b = triangles[:, 2] - triangles[:, 0]
+
+    return a[:, 0] * b[:, 1] - a[:, 1] * b[:, 0]
+
+
+def initial_params(observed, intrinsics, side):
+    """
+    Estimates a cold-start pose for each marker, assuming it roughly faces the camera: distance from apparent size,
+    position from the image centroid, and in-plane rotation from the direction of the first vertex.
+
+    :param observed: an n x 3 x 2 array of image points
+    :param intrinsics: a :class:`CameraIntrinsics` instance
+    :param side: the marker side length
+    :return: an n x 6 array of (rvec, tvec) parameters
+    """
+    centroid = observed.mean(axis = 1)
+    offsets = observed - centroid[:, None, :]
+
+    # the largest vertex distance is the least affected by foreshortening
+    pixel_radius = np.sqrt((offsets**2).sum(axis = 2)).max(axis = 1)
+    pixel_radius = np.maximum(pixel_radius, 1e-3)
+
+    z = intrinsics.fx * (side / np.sqrt(3)) / pixel_radius
+    x = (centroid[:, 0] - intrinsics.cx) * z / intrinsics.fx
+    y = (centroid[:, 1] - intrinsics.cy) * z / intrinsics.fy
+
+    # facing the camera is a half turn about x, then rotate in the image plane
+    # so the first model vertex (straight "up" once flipped) meets the first observed vertex
+    alpha = np.arctan2(offsets[:, 0, 1], offsets[:, 0, 0]) + np.pi / 2
+
+    # rotation vector of Rz(alpha) * Rx(pi), which is a half turn about the axis (cos(alpha/2), sin(alpha/2), 0)
+    rvecs = np.pi * np.column_stack((np.cos(alpha / 2), np.sin(alpha / 2), np.zeros_like(alpha)))
+
+    return np.column_stack((rvecs, x, y, z))
+
+
+def refine(params, models, observed, intrinsics, iterations = MAX_ITERATIONS):
+    """
+    Refines all poses together with a vectorized Levenberg-Marquardt iteration, minimizing reprojection error.
+
+    :param params: an n x 6 array of initial (rvec, tvec) parameters
+    :param models: an n x 3 x 3 array of model points
+    :param observed: an n x 3 x 2 array of image points
+    :param intrinsics: a :class:`CameraIntrinsics` instance
+    :param iterations: the maximum number of iterations
+    :return: the refined n x 6 parameters, and an array of RMS reprojection errors in pixels
+    """
+    n = len(params)
+    damping = np.full(n, 1e-3)
+    identity = np.eye(6)[None, :, :]
+
+    residuals = (project(params, models, intrinsics) - observed).reshape(n, 6)
+    cost = (residuals**2).sum(axis = 1)
+
+    for i in range(iterations):
+        if np.all(cost < 3 * CONVERGED_ERROR**2):
+            break
+
+        # numerical Jacobian, n x 6 residuals x 6 parameters
+        jacobian = np.empty((n, 6, 6))
+        for j in range(6):
+            step = np.zeros(6)
+            step[j] = EPSILON
+
+            shifted = (project(params + step, models, intrinsics) - observed).reshape(n, 6)
+            jacobian[:, :, j] = (shifted - residuals) / EPSILON
+
+        jt = jacobian.transpose(0, 2, 1)
+        jtj = np.matmul(jt, jacobian)
+        jtr = np.matmul(jt, residuals[:, :, None])[:, :, 0]
+
+        scaled = jtj + damping[:, None, None] * (identity * jtj + identity * 1e-9)
+        delta = np.linalg.solve(scaled, -jtr[:, :, None])[:, :, 0]
+
+        candidate = params + delta
+        candidate_residuals = (project(candidate, models, intrinsics) - observed).reshape(n, 6)
+        candidate_cost = (candidate_residuals**2).sum(axis = 1)
+
+        # accept improving steps and relax damping, otherwise increase it
+        improved = (candidate_cost < cost) & (candidate[:, 5] > 0)
+
+        params = np.where(improved[:, None], candidate, params)
+        residuals = np.where(improved[:, None], candidate_residuals, residuals)
+        cost = np.where(improved, candidate_cost, cost)
+        damping = np.where(improved, damping * 0.3, damping * 10)
+
+    return params, np.sqrt(cost / 3)
+
+
+class PoseSolver:
+    """
+    Solves poses for all live 3-point clusters of a single camera. Each solved cluster's ``pose`` attribute is set to
+    a :class:`Pose`, which is also used as the warm start on the next frame.
+    """
+
+    def __init__(self, intrinsics, side = MARKER_SIDE, iterations = MAX_ITERATIONS):
+        """
+        :param intrinsics: the camera's :class:`CameraIntrinsics`
+        :param side: the marker side length
+        :param iterations: the maximum number of refinement iterations per solve
+        """
+        self.intrinsics = intrinsics
+        self.side = side
+        self.iterations = iterations
+
+        self.model = marker_model(side)
+        self.mirrored_model = self.model[[0, 2, 1]]
+
+        #: the time taken by the most recent :meth:`solve` call, in seconds
+        self.solve_time = 0.0
+
+    def solve(self, clusters):
+        """
+        Solves the pose of every 3-point cluster in one batch.
+
+        :param clusters: a list of clusters; clusters without exactly 3 points are skipped
+        :return: a list of solved (cluster, :class:`Pose`) tuples
+        """
+        start = default_timer()
+
+        triangles = [c for c in clusters if c.size == 3]
+        if not triangles:
+            self.solve_time = default_timer() - start
+            return []
+
+        # order vertices by point index so labels (and so warm starts) are stable across frames
+        members = [sorted(c.points, key = lambda p: p.index) for c in triangles]
+        keys = [tuple(p.index for p in m) for m in members]
+        observed = np.array([[(p.x, p.y) for p in m] for m in members], dtype = float)
+
+        params = initial_params(observed, self.intrinsics, self.side)
+
+        # pick the model vertex order matching the observed winding
+        cold = np.tile(self.model, (len(triangles), 1, 1))
+        projected = project(params, cold, self.intrinsics)
+        mirrored = np.sign(signed_area(projected)) != np.sign(signed_area(observed))
+
+        for i, (cluster, key) in enumerate(zip(triangles, keys)):
+            pose = cluster.pose
+            if pose is not None and pose.members == key:
+                params[i, :3] = pose.rvec
+                params[i, 3:] = pose.tvec
+                mirrored[i] = pose.mirrored
+
+        models = np.where(mirrored[:, None, None], self.mirrored_model[None], self.model[None])
+
+        params, errors = refine(params, models, observed, self.intrinsics, self.iterations)
+
+        results = []
+        for i, cluster in enumerate(triangles):
+            cluster.pose = Pose(params[i, :3].copy(), params[i, 3:].copy(), errors[i], keys[i], mirrored[i])
+            results.append((cluster, cluster.pose))
+
+        self.solve_time = default_timer() - start
+
+        return results
@@ -0,0 +1,271 @@
+# -*- coding: utf-8 -*-
+"""
+Runtime-togglable profiling and memory accounting.
+
+Profiling can be started and stopped on a running tracker without restarting it, by default via signals:
+
+ - ``SIGUSR1`` toggles profiling; when stopped, results are written as collapsed stacks (for flame graph tools) and,
+   if ``yappi`` is installed, as a callgrind file
+ - ``SIGUSR2`` writes a memory report of live :class:`tracking.point.Point`, :class:`tracking.cluster.Cluster` and
+   :class:`tracking.vision.Circle` objects, plus the top allocation sites in their modules if ``tracemalloc`` is
+   tracing (while profiling, or always with ``trace_memory``)
+
+For example: ``kill -USR1 <pid>``, wait, then ``kill -USR1 <pid>`` again.
+"""
+
+import gc
+import os
+import signal
+import sys
+import threading
+import time
+
+from collections import Counter
+
+try:
+    import yappi
+except ImportError:
+    yappi = None
+
+try:
+    import tracemalloc
+except ImportError:
+    # python 2 requires the pytracemalloc backport
+    tracemalloc = None
+
+#: The interval between stack samples, in seconds
+SAMPLE_INTERVAL = 0.005
+
+#: Source files whose allocation sites are listed in memory reports
+TRACKED_FILES = ('point.py', 'cluster.py', 'vision.py')
+
+
+class SamplingProfiler(threading.Thread):
+    """
+    A low-overhead statistical profiler. A background thread periodically samples the stacks of all other threads and
+    counts each unique stack, which can then be written in the "collapsed" format used by flame graph tools.
+    """
+
+    def __init__(self, interval = SAMPLE_INTERVAL):
+        super(SamplingProfiler, self).__init__(name = 'sampling-profiler')
+        self.daemon = True
+
+        self.interval = interval
+        self.stacks = Counter()
+        self.running = False
+
+    def sample(self):
+        names = dict((t.ident, t.name) for t in threading.enumerate())
+
+        for ident, frame in sys._current_frames().items():
+            if ident == self.ident:
+                continue
+
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append('%s:%s:%d' % (os.path.basename(code.co_filename), code.co_name, frame.f_lineno))
+                frame = frame.f_back
+
+            stack.append(names.get(ident, str(ident)))
+            stack.reverse()
+
+            self.stacks[';'.join(stack)] += 1
+
+    def run(self):
+        self.running = True
+
+        while self.running:
+            self.sample()
+            time.sleep(self.interval)
+
+    def stop(self):
+        self.running = False
+        self.join()
+
+    def save_collapsed(self, path):
+        """
+        Writes samples in collapsed-stack format, one ``stack count`` line per unique stack.
+
+        :param path: the output file path
+        """
+        with open(path, 'w') as f:
+            for stack, count in self.stacks.most_common():
+                f.write('%s %d\n' % (stack, count))
+
+
+def _object_size(obj):
+    """
+    Approximates the memory held directly by an object: the object itself, its attribute dict, and each attribute
+    value, whether stored in the dict (e.g. the history deques of a Point) or in ``__slots__`` (e.g. the contour of a
+    Circle). Shared objects such as numpy scalars may be counted more than once.
+    """
+    size = sys.getsizeof(obj)
+
+    attributes = getattr(obj, '__dict__', None)
+    if attributes is not None:
+        size += sys.getsizeof(attributes)
+        size += sum(sys.getsizeof(value) for value in attributes.values())
+
+    for cls in getattr(type(obj), '__mro__', ()):
+        slots = cls.__dict__.get('__slots__', ())
+        if isinstance(slots, str):
+            slots = (slots, )
+
+        for name in slots:
+            if name in ('__dict__', '__weakref__') or not hasattr(obj, name):
+                continue
+
+            size += sys.getsizeof(getattr(obj, name))
+
+    return size
+
+
+def memory_report(limit = 10):
+    """
+    Accounts for memory held by live tracking objects. Object counts and approximate sizes are always reported; if
+    ``tracemalloc`` is tracing, the top allocation sites in :data:`.TRACKED_FILES` are included as well.
+
+    Allocation sites are source lines, not classes: they include everything allocated in those modules since tracing
+    started and still alive (e.g. contours and numpy arrays), not only the Point, Cluster and Circle objects themselves.
+
+    :param limit: the number of allocation sites to list
+    :return: the report, as a string
+    """
+    from cluster import Cluster
+    from point import Point
+    from vision import Circle
+
+    classes = (Point, Cluster, Circle)
+    counts = dict((cls.__name__, 0) for cls in classes)
+    sizes = dict((cls.__name__, 0) for cls in classes)
+
+    for obj in gc.get_objects():
+        for cls in classes:
+            if isinstance(obj, cls):
+                counts[cls.__name__] += 1
+                sizes[cls.__name__] += _object_size(obj)
+
+    lines = ['%-8s %8d objects %12d bytes' % (name, counts[name], sizes[name]) for name in sorted(counts)]
+
+    if tracemalloc is not None and tracemalloc.is_tracing():
+        snapshot = tracemalloc.take_snapshot().filter_traces(
+            [tracemalloc.Filter(True, '*' + os.sep + name) for name in TRACKED_FILES])
+
+        lines.append('')
+        lines.append('top live allocation sites in %s:' % ', '.join(TRACKED_FILES))
+        for stat in snapshot.statistics('lineno')[:limit]:
+            lines.append('  %s' % stat)
+    else:
+        lines.append('')
+        lines.append('allocation sites unavailable: tracemalloc is not tracing')
+
+    return '\n'.join(lines)
+
+
+class ProfilerControl:
+    """
+    The profiling control surface. Profiling can be toggled directly with :meth:`toggle`, or remotely via the signal
+    handlers registered by :meth:`install`.
+    """
+
+    def __init__(self, directory = '.', trace_memory = False):
+        """
+        :param directory: the directory to write profiles and memory reports to
+        :param trace_memory: if True, ``tracemalloc`` traces allocations from now on, so memory reports include
+                             allocation sites even when profiling isn't running; otherwise it only traces while
+                             profiling
+        """
+        self.directory = directory
+        self.profiler = None
+
+        # whether tracemalloc was started by start(), and so should be stopped by stop()
+        self.tracing = False
+
+        if trace_memory and tracemalloc is not None and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    @property
+    def is_running(self):
+        return self.profiler is not None
+
+    def _path(self, kind):
+        return os.path.join(self.directory, 'tracking-%d-%s.%s' % (os.getpid(), time.strftime('%Y%m%d-%H%M%S'), kind))
+
+    def start(self):
+        if self.is_running:
+            return
+
+        self.profiler = SamplingProfiler()
+        self.profiler.start()
+
+        if yappi is not None:
+            yappi.clear_stats()
+            yappi.start()
+
+        if tracemalloc is not None and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self.tracing = True
+
+        print "profiling started"
+
+    def stop(self):
+        """
+        Stops profiling and writes the results.
+
+        :return: a list of written file paths
+        """
+        if not self.is_running:
+            return []
+
+        self.profiler.stop()
+
+        paths = [self._path('collapsed')]
+        self.profiler.save_collapsed(paths[0])
+        self.profiler = None
+
+        if yappi is not None:
+            yappi.stop()
+
+            paths.append(self._path('cg'))
+            yappi.get_func_stats().save(paths[-1], type = 'callgrind')
+
+        if self.tracing:
+            tracemalloc.stop()
+            self.tracing = False
+
+        print "profiling stopped, wrote %s" % ', '.join(paths)
+
+        return paths
+
+    def toggle(self):
+        if self.is_running:
+            self.stop()
+        else:
+            self.start()
+
+    def dump_memory(self):
+        """
+        Writes a :func:`memory_report` to a file.
+
+        :return: the written file path
+        """
+        path = self._path('mem.txt')
+
+        with open(path, 'w') as f:
+            f.write(memory_report())
+            f.write('\n')
+
+        print "wrote memory report %s" % path
+
+        return path
+
+    def install(self, toggle_signal = signal.SIGUSR1, memory_signal = signal.SIGUSR2):
+        """
+        Registers signal handlers. Must be called from the main thread.
+
+        :param toggle_signal: the signal that toggles profiling
+        :param memory_signal: the signal that writes a memory report
+        """
+        signal.signal(toggle_signal, lambda signum, frame: self.toggle())
+        signal.signal(memory_signal, lambda signum, frame: self.dump_memory())
@@ -0,0 +1,334 @@
+# -*- coding: utf-8 -*-
+"""
+Streaming of tracking results to local consumers, e.g. a game engine or robot controller, in other processes.
+
+A :class:`Publisher` encodes each frame's points and clusters with :mod:`tracking.schema` and sends them over any
+combination of:
+
+ - UDP datagrams, one message per datagram, to a fixed list of addresses
+ - TCP or Unix stream sockets, to any number of connected clients; each message is prefixed with its length as a
+   little-endian uint32
+
+Encoding happens on the publishing thread, and takes about 0.1 ms for a hundred points, while all socket I/O runs on
+the publisher's own thread around ``select``. Each stream client has a bounded queue of outgoing messages: a client that can't keep up
+loses its oldest messages rather than slowing down tracking or other clients. Lost messages show as gaps in the
+sequence number.
+
+A :class:`Subscriber` is a minimal client for any of the transports.
+"""
+
+import errno
+import os
+import select
+import socket
+import struct
+
+from collections import deque
+from threading import Thread, Lock
+
+from schema import encode, decode
+
+#: The number of messages queued per stream client before the oldest are dropped
+CLIENT_QUEUE_SIZE = 8
+
+#: The largest message that can be sent as a single UDP datagram
+MAX_DATAGRAM = 65507
+
+LENGTH = struct.Struct('<I')
+
+
+class StreamClient:
+    """
+    A connected stream client and its outgoing message queue.
+    """
+
+    def __init__(self, sock, queue_size):
+        self.sock = sock
+        self.queue = deque(maxlen = queue_size)
+
+        # the remainder of a partially sent message
+        self.pending = b''
+
+        #: the number of messages dropped because this client fell behind
+        self.dropped = 0
+
+    def enqueue(self, data):
+        if len(self.queue) == self.queue.maxlen:
+            self.dropped += 1
+
+        self.queue.append(data)
+
+    @property
+    def is_waiting(self):
+        return bool(self.pending) or bool(self.queue)
+
+    def flush(self):
+        """
+        Sends as much queued data as the socket accepts without blocking.
+        """
+        while True:
+            if not self.pending:
+                if not self.queue:
+                    return
+
+                self.pending = self.queue.popleft()
+
+            sent = self.sock.send(self.pending)
+            self.pending = self.pending[sent:]
+
+            if self.pending:
+                return
+
+
+class Publisher(Thread):
+    """
+    Publishes tracking results over UDP, TCP and/or Unix sockets.
+    """
+
+    def __init__(self, udp = None, tcp = None, unix = None, queue_size = CLIENT_QUEUE_SIZE, scheduler = None):
+        """
+        :param udp: a list of (host, port) addresses to send datagrams to
+        :param tcp: a (host, port) address to accept TCP clients on
+        :param unix: a filesystem path to accept Unix socket clients on
+        :param queue_size: the number of messages queued per stream client before the oldest are dropped
+        :param scheduler: an optional :class:`tracking.scheduler.CoreScheduler`; when started, the I/O thread is
+                          pinned to the cores budgeted for the ``publisher`` stage
+        """
+        super(Publisher, self).__init__(name = 'publisher')
+        self.daemon = True
+
+        self.queue_size = queue_size
+        self.scheduler = scheduler
+        self.udp_addresses = list(udp or [])
+
+        self.udp = None
+        if self.udp_addresses:
+            self.udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.udp.setblocking(False)
+
+        self.listeners = []
+        if tcp is not None:
+            listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            listener.bind(tcp)
+            self.listeners.append(listener)
+
+        self.unix_path = unix
+        if unix is not None:
+            if os.path.exists(unix):
+                os.remove(unix)
+
+            listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            listener.bind(unix)
+            self.listeners.append(listener)
+
+        for listener in self.listeners:
+            listener.listen(5)
+            listener.setblocking(False)
+
+        self.clients = []
+        self.lock = Lock()
+
+        # written to wake the I/O thread when new messages are queued
+        self.wake_read, self.wake_write = os.pipe()
+
+        self.sequence = 0
+        self.running = False
+
+        #: the number of messages dropped across all transports
+        self.dropped = 0
+
+    @property
+    def addresses(self):
+        """
+        :return: the bound address of each stream listener, e.g. to find an automatically assigned TCP port
+        """
+        return [listener.getsockname() for listener in self.listeners]
+
+    def publish(self, camera, frame_count, timestamp, points, clusters):
+        """
+        Encodes and queues a frame's results for all clients. Never blocks.
+
+        :param camera: the camera index
+        :param frame_count: the frame number
+        :param timestamp: the frame's capture time, in seconds
+        :param points: a list of :class:`tracking.point.Point` instances
+        :param clusters: a list of :class:`tracking.cluster.Cluster` instances
+        :return: the encoded message
+        """
+        with self.lock:
+            sequence = self.sequence
+            self.sequence += 1
+
+        data = encode(camera, sequence, frame_count, timestamp, points, clusters)
+
+        if self.udp is not None:
+            dropped = 0
+            if len(data) > MAX_DATAGRAM:
+                dropped = len(self.udp_addresses)
+            else:
+                for address in self.udp_addresses:
+                    try:
+                        self.udp.sendto(data, address)
+                    except socket.error:
+                        # the send buffer is full, or nobody is listening
+                        dropped += 1
+
+            if dropped:
+                # publish() is called from every camera thread
+                with self.lock:
+                    self.dropped += dropped
+
+        if self.clients:
+            framed = LENGTH.pack(len(data)) + data
+
+            with self.lock:
+                for client in self.clients:
+                    client.enqueue(framed)
+
+            self._wake()
+
+        return data
+
+    def _wake(self):
+        try:
+            os.write(self.wake_write, b'x')
+        except OSError:
+            pass
+
+    def _accept(self, listener):
+        try:
+            sock, address = listener.accept()
+        except socket.error:
+            return
+
+        sock.setblocking(False)
+        if sock.family == socket.AF_INET:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        with self.lock:
+            self.clients.append(StreamClient(sock, self.queue_size))
+
+    def _disconnect(self, client):
+        with self.lock:
+            self.clients.remove(client)
+            self.dropped += client.dropped + len(client.queue)
+
+        client.sock.close()
+
+    def start(self):
+        # set before the thread runs, so an immediate stop() isn't lost
+        self.running = True
+        super(Publisher, self).start()
+
+    def run(self):
+        if self.scheduler is not None:
+            self.scheduler.enter(self.name)
+
+        while self.running:
+            with self.lock:
+                clients = list(self.clients)
+
+            readable = [self.wake_read] + self.listeners + [c.sock for c in clients]
+            writable = [c.sock for c in clients if c.is_waiting]
+
+            readable, writable, _ = select.select(readable, writable, [], 0.5)
+
+            if self.wake_read in readable:
+                os.read(self.wake_read, 4096)
+
+            for listener in self.listeners:
+                if listener in readable:
+                    self._accept(listener)
+
+            for client in clients:
+                try:
+                    if client.sock in readable and not client.sock.recv(4096):
+                        # clients aren't expected to send anything, so this is a disconnect
+                        self._disconnect(client)
+                        continue
+
+                    with self.lock:
+                        client.flush()
+                except socket.error as e:
+                    if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                        self._disconnect(client)
+
+        self._close()
+
+    def stop(self):
+        self.running = False
+        self._wake()
+        self.join()
+
+    def _close(self):
+        for client in list(self.clients):
+            self._disconnect(client)
+
+        for listener in self.listeners:
+            listener.close()
+
+        if self.unix_path is not None and os.path.exists(self.unix_path):
+            os.remove(self.unix_path)
+
+        if self.udp is not None:
+            self.udp.close()
+
+        os.close(self.wake_read)
+        os.close(self.wake_write)
+
+
+class Subscriber:
+    """
+    A blocking client for a :class:`Publisher`.
+    """
+
+    def __init__(self, udp = None, tcp = None, unix = None):
+        """
+        Exactly one transport should be given.
+
+        :param udp: a (host, port) address to receive datagrams on
+        :param tcp: a (host, port) address to connect to
+        :param unix: a Unix socket path to connect to
+        """
+        if udp is not None:
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.sock.bind(udp)
+            self.stream = False
+        elif tcp is not None:
+            self.sock = socket.create_connection(tcp)
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.stream = True
+        elif unix is not None:
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.sock.connect(unix)
+            self.stream = True
+        else:
+            raise ValueError("no transport given")
+
+    def _read_exactly(self, size):
+        data = b''
+        while len(data) < size:
+            chunk = self.sock.recv(size - len(data))
+            if not chunk:
+                raise EOFError("publisher disconnected")
+
+            data += chunk
+
+        return data
+
+    def receive(self):
+        """
+        Waits for the next message.
+
+        :return: a :class:`tracking.schema.Message`
+        """
+        if not self.stream:
+            return decode(self.sock.recv(MAX_DATAGRAM))
+
+        size, = LENGTH.unpack(self._read_exactly(LENGTH.size))
+
+        return decode(self._read_exactly(size))
+
+    def close(self):
+        self.sock.close()
@@ -0,0 +1,245 @@
+# -*- coding: utf-8 -*-
+"""
+Raw frame recording and replay.
+
+Replaying a compressed video through ``cv2.VideoCapture`` adds decoding cost to every measurement, and lossy codecs
+don't reproduce the original frames exactly. A :class:`FrameRecorder` instead writes raw captured frames, each with its
+capture timestamp, to a simple uncompressed file. A :class:`RawFrameSource` memory-maps a recording and hands out
+frames as zero-copy views, either as fast as possible or paced in real time, so vision and tracking performance can be
+measured in isolation and reproduced exactly.
+
+A recording is a 64 byte header (magic ``TRKR``, version, frame height, width and channels) followed by one record per
+frame: the capture timestamp as a little-endian double, padded to 64 bytes, then the raw 8-bit frame data, padded to a
+multiple of 64 bytes so that every record, and so every frame, is 64 byte aligned. The frame count follows from the
+file size, so a recording cut short (e.g. by a crash) remains readable.
+"""
+
+import mmap
+import os
+import struct
+import time
+
+import cv2
+import numpy as np
+
+from latency import monotonic, read_frame
+
+#: The magic bytes at the start of every recording
+MAGIC = b'TRKR'
+
+#: The recording format version
+VERSION = 3
+
+#: The recording header: magic, version, height, width, channels, padded to 64 bytes
+HEADER = struct.Struct('<4sHIIH48x')
+assert HEADER.size == 64
+
+# the timestamp and padding before each frame, keeping frame data 64 byte aligned
+RECORD_PREFIX = struct.Struct('<d56x')
+assert RECORD_PREFIX.size == 64
+
+
+def frame_padding(height, width, channels):
+    """
+    :return: the number of bytes after a frame's data that keep the next record 64 byte aligned
+    """
+    return -(height * width * channels) % 64
+
+
+def record_dtype(height, width, channels):
+    """
+    :return: the layout of a single frame record
+    """
+    fields = [
+        ('timestamp', '<f8'),
+        ('padding', 'V56'),
+        ('frame', np.uint8, (height, width, channels))
+    ]
+
+    padding = frame_padding(height, width, channels)
+    if padding:
+        fields.append(('frame_padding', 'V%d' % padding))
+
+    return np.dtype(fields)
+
+
+class FrameRecorder:
+    """
+    Writes raw frames and their capture timestamps to a recording file.
+    """
+
+    def __init__(self, path):
+        """
+        :param path: the recording file to create
+        """
+        self.path = path
+        self.file = open(path, 'wb')
+        self.shape = None
+        self.padding = b''
+
+        #: the number of frames written
+        self.count = 0
+
+    def write(self, frame, timestamp = None):
+        """
+        Appends a frame. All frames of a recording must have the same size.
+
+        :param frame: an 8-bit BGR (or grayscale) frame
+        :param timestamp: the frame's monotonic capture time, by default now
+        """
+        if timestamp is None:
+            timestamp = monotonic()
+
+        if frame.ndim == 2:
+            frame = frame[:, :, None]
+
+        if self.shape is None:
+            self.shape = frame.shape
+            self.padding = b'\0' * frame_padding(*self.shape)
+            self.file.write(HEADER.pack(MAGIC, VERSION, *self.shape))
+        elif frame.shape != self.shape:
+            raise ValueError("frame size %s does not match the recording size %s" % (frame.shape, self.shape))
+
+        self.file.write(RECORD_PREFIX.pack(timestamp))
+        self.file.write(np.ascontiguousarray(frame, dtype = np.uint8).data)
+        self.file.write(self.padding)
+
+        self.count += 1
+
+    def close(self):
+        self.file.close()
+
+
+def record(source, path, frames = None):
+    """
+    Records frames from a camera or video to a file.
+
+    :param source: a camera index or video file, passed to ``cv2.VideoCapture``, or an object with a compatible
+                   ``read()`` method; a capture passed in is left open
+    :param path: the recording file to create
+    :param frames: the number of frames to record, by default until the end of the stream
+    :return: the number of frames recorded
+    """
+    capture = source
+    opened = not hasattr(source, 'read')
+    if opened:
+        # noinspection PyArgumentList
+        capture = cv2.VideoCapture(source)
+
+    recorder = FrameRecorder(path)
+    try:
+        while frames is None or recorder.count < frames:
+            frame, timestamp = read_frame(capture)
+            if frame is None:
+                break
+
+            recorder.write(frame, timestamp)
+    finally:
+        recorder.close()
+        if opened:
+            capture.release()
+
+    return recorder.count
+
+
+class RawFrameSource:
+    """
+    Replays a recording made by a :class:`FrameRecorder`. Provides a ``cv2.VideoCapture``-like ``read()`` method, so it
+    can be given to a :class:`tracking.main.TrackingThread` in place of a camera.
+
+    Frames are copy-on-write views of the mapped file: nothing is copied unless a frame is modified.
+    """
+
+    def __init__(self, path, realtime = False, loop = False):
+        """
+        :param path: the recording file
+        :param realtime: if True, :meth:`read` waits so frames are delivered at their recorded intervals; otherwise
+                         frames are delivered as fast as they are read
+        :param loop: if True, replay restarts from the first frame at the end of the recording
+        """
+        self.path = path
+        self.realtime = realtime
+        self.loop = loop
+
+        with open(path, 'rb') as f:
+            header = f.read(HEADER.size)
+            if len(header) < HEADER.size:
+                raise ValueError("not a frame recording: %s" % path)
+
+            magic, version, height, width, channels = HEADER.unpack(header)
+            if magic != MAGIC:
+                raise ValueError("not a frame recording: %s" % path)
+
+            if version != VERSION:
+                raise ValueError("unsupported recording version: %d" % version)
+
+            dtype = record_dtype(height, width, channels)
+            count = (os.fstat(f.fileno()).st_size - HEADER.size) // dtype.itemsize
+
+            self.map = None
+            if count > 0:
+                self.map = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_COPY)
+
+        self.shape = (height, width, channels)
+
+        self.records = np.zeros(0, dtype)
+        if self.map is not None:
+            self.records = np.frombuffer(self.map, dtype, count, HEADER.size)
+
+        #: the recorded capture time of every frame
+        self.timestamps = self.records['timestamp']
+
+        self.index = 0
+        self.start = None
+
+        #: the monotonic time at which the most recently read frame was delivered
+        self.timestamp = None
+
+    def __len__(self):
+        return len(self.records)
+
+    def __getitem__(self, index):
+        """
+        :param index: the frame index
+        :return: the frame, as a view of the recording
+        """
+        return self.records['frame'][index]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def read(self):
+        """
+        Returns the next frame.
+
+        :return: a (success, frame) tuple; at the end of the recording, (False, None)
+        """
+        if self.index >= len(self):
+            if not self.loop or not len(self):
+                return False, None
+
+            self.index = 0
+            self.start = None
+
+        if self.realtime:
+            now = monotonic()
+            if self.start is None:
+                self.start = now - (self.timestamps[self.index] - self.timestamps[0])
+
+            delay = self.start + (self.timestamps[self.index] - self.timestamps[0]) - now
+            if delay > 0:
+                time.sleep(delay)
+
+        frame = self[self.index]
+        self.index += 1
+
+        self.timestamp = monotonic()
+
+        return True, frame
+
+    def release(self):
+        # the map is closed once no frame views remain
+        self.records = np.zeros(0, self.records.dtype)
+        self.timestamps = self.records['timestamp']
+        self.map = None
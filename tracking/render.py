@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+"""
+Asynchronous overlay rendering and video encoding.
+
+Drawing overlays and encoding video are far slower than draining the tracking queues, so a :class:`RenderWorker` does
+both on its own thread. Frames are submitted to a small bounded queue; when the encoder falls behind, frames are
+dropped according to the worker's drop policy rather than blocking the caller, so encoding never holds back tracking.
+
+Overlay geometry is computed at submission time (see :meth:`tracking.cluster.Cluster.overlay`), since tracking
+continues to update points and clusters while a frame waits to be rendered.
+"""
+
+import cv2
+
+from Queue import Queue, Empty, Full
+from threading import Thread, Lock
+
+from cluster import draw_overlays
+
+#: The default number of frames waiting to be rendered before frames are dropped
+RENDER_QUEUE_SIZE = 4
+
+#: Drop the oldest waiting frame to make room for a new one
+DROP_OLDEST = 'oldest'
+
+#: Drop new frames while the queue is full
+DROP_NEWEST = 'newest'
+
+
+def draw_frame(image, frame_count, overlays):
+    """
+    Draws cluster overlays and the frame number onto an image.
+
+    :param image: the BGR image to draw on
+    :param frame_count: the frame number
+    :param overlays: a list of overlay tuples, see :meth:`tracking.cluster.Cluster.overlay`
+    :return: the image
+    """
+    draw_overlays(image, overlays)
+
+    cv2.putText(image, "Frame #%d" % frame_count,
+                (10, 470),
+                cv2.FONT_HERSHEY_SIMPLEX, 0.4,
+                (255, 255, 255), lineType = cv2.LINE_AA)
+
+    return image
+
+
+class RenderWorker(Thread):
+    """
+    Renders overlays onto submitted frames and writes them to an output, e.g. a ``cv2.VideoWriter``, on a dedicated
+    thread.
+    """
+
+    def __init__(self, output, queue_size = RENDER_QUEUE_SIZE, drop = DROP_OLDEST, scheduler = None):
+        """
+        :param output: an object with a ``write(image)`` method, such as a ``cv2.VideoWriter``
+        :param queue_size: the number of frames that may wait to be rendered
+        :param drop: the drop policy when the queue is full, either :data:`.DROP_OLDEST` or :data:`.DROP_NEWEST`
+        :param scheduler: an optional :class:`tracking.scheduler.CoreScheduler`; when started, this thread is pinned
+                          to the cores budgeted for the ``render`` stage
+        """
+        super(RenderWorker, self).__init__(name = 'render')
+        self.daemon = True
+
+        if drop not in (DROP_OLDEST, DROP_NEWEST):
+            raise ValueError("unknown drop policy: %r" % drop)
+
+        self.output = output
+        self.drop = drop
+        self.scheduler = scheduler
+        self.queue = Queue(maxsize = queue_size)
+
+        self.submit_lock = Lock()
+
+        #: the number of frames rendered and written
+        self.rendered = 0
+
+        #: the number of frames dropped because the queue was full
+        self.dropped = 0
+
+    def submit(self, frame_count, frame, clusters):
+        """
+        Queues a frame for rendering. Never blocks.
+
+        :param frame_count: the frame number
+        :param frame: the frame; a copy is queued, as tracking threads reuse their output buffers
+        :param clusters: the frame's clusters
+        :return: True if the frame was queued, False if it was dropped
+        """
+        item = (frame_count, frame.copy(), [cluster.overlay() for cluster in clusters])
+
+        with self.submit_lock:
+            try:
+                self.queue.put_nowait(item)
+                return True
+            except Full:
+                pass
+
+            self.dropped += 1
+            if self.drop == DROP_NEWEST:
+                return False
+
+            try:
+                self.queue.get_nowait()
+            except Empty:
+                pass
+
+            # only submit() adds to the queue, so there is room now
+            self.queue.put_nowait(item)
+
+        return True
+
+    def run(self):
+        if self.scheduler is not None:
+            self.scheduler.enter(self.name)
+
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+
+            frame_count, image, overlays = item
+            self.output.write(draw_frame(image, frame_count, overlays))
+
+            self.rendered += 1
+
+    def stop(self):
+        """
+        Renders any frames still waiting, then stops the worker.
+        """
+        with self.submit_lock:
+            self.queue.put(None)
+
+        self.join()
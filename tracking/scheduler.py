@@ -0,0 +1,234 @@
+# -*- coding: utf-8 -*-
+"""
+CPU core budgeting for camera workers and other processing stages.
+
+Every camera thread calls into OpenCV, which may start its own internal thread pool; with several cameras, this
+oversubscribes the CPU and causes latency spikes. A :class:`CoreScheduler` takes a total core budget and splits it:
+stages with a fixed need (e.g. rendering) get the cores they ask for, and camera workers share the rest. Each worker
+thread is pinned to its own cores when it calls :meth:`CoreScheduler.enter`.
+
+OpenCV has a single, process-wide thread pool, whose threads would inherit the affinity of whichever worker first
+used it, so it can't respect per-worker pinning. The pool is therefore disabled (``cv2.setNumThreads(0)``), and OpenCV
+functions run on the calling worker's own pinned thread.
+
+Per-worker CPU utilization is measured from ``/proc``, so capacity can be judged before adding cameras. Pinning and
+utilization are only available on Linux; elsewhere, only the OpenCV pool is disabled.
+"""
+
+import ctypes
+import ctypes.util
+import os
+import platform
+
+import cv2
+
+from multiprocessing import cpu_count
+from threading import Lock
+
+from latency import monotonic
+
+# gettid() has no wrapper in older C libraries, so it is called by syscall number
+SYS_GETTID = {
+    'x86_64': 186,
+    'i386': 224,
+    'i686': 224,
+    'aarch64': 178,
+    'armv7l': 224
+}
+
+try:
+    libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno = True)
+    libc.sched_setaffinity
+except (OSError, AttributeError):
+    libc = None
+
+
+def gettid():
+    """
+    :return: the kernel thread id of the calling thread, or None if unavailable
+    """
+    number = SYS_GETTID.get(platform.machine())
+    if libc is None or number is None:
+        return None
+
+    return libc.syscall(number)
+
+
+def available_cores():
+    """
+    :return: a sorted list of the CPU ids this process may run on
+    """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('Cpus_allowed_list:'):
+                    cores = []
+                    for part in line.split(':', 1)[1].strip().split(','):
+                        if '-' in part:
+                            first, last = part.split('-')
+                            cores.extend(range(int(first), int(last) + 1))
+                        else:
+                            cores.append(int(part))
+
+                    return sorted(cores)
+    except IOError:
+        pass
+
+    return range(cpu_count())
+
+
+def set_affinity(tid, cores):
+    """
+    Pins a thread to a set of cores.
+
+    :param tid: the kernel thread id, see :func:`gettid`
+    :param cores: a list of CPU ids
+    :return: True if the affinity was set
+    """
+    if libc is None or tid is None:
+        return False
+
+    mask_type = ctypes.c_ulong * (max(cores) // (8 * ctypes.sizeof(ctypes.c_ulong)) + 1)
+    mask = mask_type()
+
+    bits = 8 * ctypes.sizeof(ctypes.c_ulong)
+    for core in cores:
+        mask[core // bits] |= 1 << (core % bits)
+
+    return libc.sched_setaffinity(tid, ctypes.sizeof(mask), ctypes.byref(mask)) == 0
+
+
+def thread_cpu_time(tid):
+    """
+    :param tid: the kernel thread id
+    :return: the CPU time used by a thread of this process so far, in seconds, or None if unavailable
+    """
+    try:
+        with open('/proc/self/task/%d/stat' % tid) as f:
+            stat = f.read()
+    except (IOError, TypeError):
+        return None
+
+    # the command name may contain spaces, so fields are counted from its closing parenthesis
+    fields = stat[stat.rindex(')') + 2:].split()
+    utime, stime = int(fields[11]), int(fields[12])
+
+    return (utime + stime) / float(os.sysconf('SC_CLK_TCK'))
+
+
+class Worker:
+    """
+    A worker thread registered with a :class:`CoreScheduler`.
+    """
+
+    def __init__(self, name, cores):
+        self.name = name
+        self.cores = cores
+
+        self.tid = None
+        self.pinned = False
+
+        self.last_cpu = None
+        self.last_time = None
+
+        #: the CPU time used since the previous :meth:`CoreScheduler.report`, in cores
+        self.utilization = 0.0
+
+
+class CoreScheduler:
+    """
+    Splits a core budget across stages and camera workers.
+    """
+
+    def __init__(self, budget = None, stages = None, workers = ()):
+        """
+        :param budget: the total number of cores to use, by default all available cores
+        :param stages: a dict of stage name to a fixed number of cores, e.g. ``{'render': 1}``
+        :param workers: the names of the camera workers sharing the remaining cores, e.g. the
+                        :class:`tracking.main.TrackingThread` names
+        """
+        cores = available_cores()
+        if budget is None:
+            budget = len(cores)
+
+        self.budget = max(1, min(budget, len(cores)))
+        self.cores = cores[:self.budget]
+
+        self.lock = Lock()
+        self.workers = {}
+
+        # stages are given their cores first, then workers share the rest (or all cores, if none are left)
+        offset = 0
+        for name, count in sorted((stages or {}).items()):
+            count = max(1, min(count, self.budget - 1))
+            self.workers[name] = Worker(name, [self.cores[(offset + i) % self.budget] for i in range(count)])
+            offset += count
+
+        shared = self.cores[offset:] or self.cores
+
+        workers = list(workers)
+        for i, name in enumerate(workers):
+            share = shared[i * len(shared) // len(workers):(i + 1) * len(shared) // len(workers)]
+            if not share:
+                # more workers than cores, so workers share cores round-robin
+                share = [shared[i % len(shared)]]
+
+            self.workers[name] = Worker(name, share)
+
+        # 0 runs OpenCV functions on the calling (pinned) thread, without the shared pool
+        cv2.setNumThreads(0)
+
+    def enter(self, name):
+        """
+        Registers the calling thread as the named worker, and pins it to the worker's cores. Should be called at the
+        start of the worker thread's ``run()``.
+
+        :param name: the worker or stage name
+        :return: the :class:`Worker`
+        """
+        with self.lock:
+            worker = self.workers.get(name)
+            if worker is None:
+                # an unplanned worker shares every core in the budget
+                worker = self.workers[name] = Worker(name, list(self.cores))
+
+        worker.tid = gettid()
+        worker.pinned = set_affinity(worker.tid, worker.cores)
+
+        worker.last_cpu = thread_cpu_time(worker.tid)
+        worker.last_time = monotonic()
+
+        return worker
+
+    def report(self):
+        """
+        Measures each running worker's CPU utilization since the previous report.
+
+        :return: a list of (name, cores, utilization, load) tuples, where utilization is in cores, and load is the
+                 fraction of the worker's own cores in use
+        """
+        now = monotonic()
+
+        results = []
+        for name in sorted(self.workers):
+            worker = self.workers[name]
+
+            cpu = thread_cpu_time(worker.tid)
+            if cpu is not None and worker.last_cpu is not None and now > worker.last_time:
+                worker.utilization = (cpu - worker.last_cpu) / (now - worker.last_time)
+                worker.last_cpu = cpu
+                worker.last_time = now
+
+            results.append((name, worker.cores, worker.utilization, worker.utilization / len(worker.cores)))
+
+        return results
+
+    def format_report(self):
+        """
+        :return: a human readable :meth:`report`, one line per worker
+        """
+        lines = ['%-16s cores %-12s %5.2f cores used (%3.0f%%)' % (name, ','.join(str(c) for c in cores), used,
+                                                                  load * 100)
+                 for name, cores, used, load in self.report()]
+
+        return '\n'.join(lines)
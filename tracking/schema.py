@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+"""
+A compact, fixed-layout binary encoding of per-frame tracking results, for consumers outside of the tracking process.
+
+Each message is a header followed by a packed array of point records and a packed array of cluster records, all
+little-endian:
+
+ - header (:data:`.HEADER`): magic ``TRK1``, schema version, camera index, sequence number, frame number, capture
+   timestamp in seconds, point count and cluster count
+ - points (:data:`.POINT_DTYPE`): index, smoothed position, velocity, quality and the index of the owning cluster
+   (-1 if none)
+ - clusters (:data:`.CLUSTER_DTYPE`): index, center, point count, and pose (NaN if not solved)
+
+Records map directly onto NumPy structured arrays, so decoding is a zero-copy view of the message buffer.
+"""
+
+import struct
+
+import numpy as np
+
+from collections import namedtuple
+from itertools import chain
+from operator import attrgetter
+
+from point import POINT_MAX_HEALTH
+
+#: The magic bytes at the start of every message
+MAGIC = b'TRK1'
+
+#: The schema version, incremented on any layout change
+VERSION = 1
+
+#: The message header: magic, version, camera, sequence, frame number, timestamp, point count, cluster count
+HEADER = struct.Struct('<4sHHIIdHH')
+
+#: The layout of a single point record
+POINT_DTYPE = np.dtype([
+    ('index', '<u4'),
+    ('x', '<f4'),
+    ('y', '<f4'),
+    ('vx', '<f4'),
+    ('vy', '<f4'),
+    ('quality', '<f4'),
+    ('cluster', '<i4')
+])
+
+#: The layout of a single cluster record
+CLUSTER_DTYPE = np.dtype([
+    ('index', '<u4'),
+    ('x', '<f4'),
+    ('y', '<f4'),
+    ('size', '<u4'),
+    ('rvec', '<f4', (3,)),
+    ('tvec', '<f4', (3,)),
+    ('error', '<f4')
+])
+
+NAN_POSE = (float('nan'),) * 3
+
+# the point and cluster attributes gathered in a single pass, see point_records() and cluster_records()
+POINT_FIELDS = attrgetter('index', 'x_window_mean', 'y_window_mean', 'x_velocity_mean', 'y_velocity_mean', 'health',
+                          'circularity_mean')
+CLUSTER_FIELDS = attrgetter('index', 'center.x', 'center.y', 'size')
+
+#: A decoded message. ``points`` and ``clusters`` are structured arrays of :data:`.POINT_DTYPE` and
+#: :data:`.CLUSTER_DTYPE`.
+Message = namedtuple('Message', 'camera sequence frame_count timestamp points clusters')
+
+
+class SchemaError(ValueError):
+    """
+    Raised when a message can't be decoded.
+    """
+    pass
+
+
+def point_records(points, clusters):
+    """
+    Packs points into an array of point records.
+
+    :param points: a list of :class:`tracking.point.Point` instances
+    :param clusters: a list of :class:`tracking.cluster.Cluster` instances, used for cluster assignments
+    :return: an array of :data:`.POINT_DTYPE`
+    """
+    owners = {}
+    for cluster in clusters:
+        for point in cluster.points:
+            owners[point.index] = cluster.index
+
+    count = len(points)
+    records = np.empty(count, POINT_DTYPE)
+
+    # gather every attribute in one pass, then fill the records column by column
+    values = np.fromiter(chain.from_iterable(map(POINT_FIELDS, points)), float, 7 * count).reshape(count, 7)
+
+    records['index'] = values[:, 0]
+    records['x'] = values[:, 1]
+    records['y'] = values[:, 2]
+    records['vx'] = values[:, 3]
+    records['vy'] = values[:, 4]
+
+    # tracking.point.Point.quality, for all points at once
+    records['quality'] = 0.75 * (np.maximum(values[:, 5], 0) / float(POINT_MAX_HEALTH)) + 0.25 * values[:, 6]
+
+    records['cluster'] = [owners.get(index, -1) for index in records['index'].tolist()]
+
+    return records
+
+
+def cluster_records(clusters):
+    """
+    Packs clusters into an array of cluster records.
+
+    :param clusters: a list of :class:`tracking.cluster.Cluster` instances
+    :return: an array of :data:`.CLUSTER_DTYPE`
+    """
+    count = len(clusters)
+    records = np.empty(count, CLUSTER_DTYPE)
+
+    values = np.fromiter(chain.from_iterable(map(CLUSTER_FIELDS, clusters)), float, 4 * count).reshape(count, 4)
+
+    records['index'] = values[:, 0]
+    records['x'] = values[:, 1]
+    records['y'] = values[:, 2]
+    records['size'] = values[:, 3]
+
+    records['rvec'] = np.nan
+    records['tvec'] = np.nan
+    records['error'] = np.nan
+
+    for record, c in zip(records, clusters):
+        if c.pose is not None:
+            record['rvec'] = np.ravel(c.pose.rvec)
+            record['tvec'] = np.ravel(c.pose.tvec)
+            record['error'] = c.pose.error
+
+    return records
+
+
+def message_size(point_count, cluster_count):
+    """
+    :return: the encoded size, in bytes, of a message with the given number of records
+    """
+    return HEADER.size + point_count * POINT_DTYPE.itemsize + cluster_count * CLUSTER_DTYPE.itemsize
+
+
+def encode(camera, sequence, frame_count, timestamp, points, clusters):
+    """
+    Encodes a frame's tracking results.
+
+    :param camera: the camera index
+    :param sequence: the message sequence number
+    :param frame_count: the frame number
+    :param timestamp: the frame's capture time, in seconds
+    :param points: a list of :class:`tracking.point.Point` instances
+    :param clusters: a list of :class:`tracking.cluster.Cluster` instances
+    :return: the encoded message
+    """
+    point_array = point_records(points, clusters)
+    cluster_array = cluster_records(clusters)
+
+    header = HEADER.pack(MAGIC, VERSION, camera, sequence & 0xffffffff, frame_count & 0xffffffff, timestamp,
+                         len(point_array), len(cluster_array))
+
+    return header + point_array.tobytes() + cluster_array.tobytes()
+
+
+def decode_header(data):
+    """
+    Decodes and validates a message header.
+
+    :param data: a buffer of at least :data:`.HEADER` size bytes
+    :return: a (camera, sequence, frame number, timestamp, point count, cluster count) tuple
+    """
+    if len(data) < HEADER.size:
+        raise SchemaError("message too short: %d bytes" % len(data))
+
+    magic, version, camera, sequence, frame_count, timestamp, point_count, cluster_count = \
+        HEADER.unpack_from(data)
+
+    if magic != MAGIC:
+        raise SchemaError("bad magic: %r" % magic)
+
+    if version != VERSION:
+        raise SchemaError("unsupported schema version: %d" % version)
+
+    return camera, sequence, frame_count, timestamp, point_count, cluster_count
+
+
+def decode(data):
+    """
+    Decodes a message. The returned record arrays are read-only views of ``data``.
+
+    :param data: an encoded message
+    :return: a :class:`Message`
+    """
+    camera, sequence, frame_count, timestamp, point_count, cluster_count = decode_header(data)
+
+    size = message_size(point_count, cluster_count)
+    if len(data) < size:
+        raise SchemaError("message truncated: %d of %d bytes" % (len(data), size))
+
+    points = np.frombuffer(data, POINT_DTYPE, point_count, HEADER.size)
+    clusters = np.frombuffer(data, CLUSTER_DTYPE, cluster_count, HEADER.size + points.nbytes)
+
+    return Message(camera, sequence, frame_count, timestamp, points, clusters)
@@ -0,0 +1,260 @@
+# -*- coding: utf-8 -*-
+"""
+Shared-memory export of tracking results, for consumers on the same machine.
+
+A :class:`SharedMemoryWriter` writes each frame's points and clusters into a ring of fixed-size slots in a
+memory-mapped file, using the record layouts of :mod:`tracking.schema`. Readers in other processes map the same file
+with a :class:`SharedMemoryReader` and see the records as NumPy arrays directly in shared memory, with no sockets,
+syscalls or serialization per frame.
+
+Each slot is guarded by a sequence lock: the writer makes a slot's sequence odd while writing it, and even again once
+done. Readers check the sequence before and after reading a slot, and retry if it changed, so the writer never waits
+on readers.
+"""
+
+import mmap
+import os
+import tempfile
+
+import numpy as np
+
+from schema import VERSION, POINT_DTYPE, CLUSTER_DTYPE, Message, SchemaError, point_records, cluster_records
+
+#: The directory ring files are created in by default, preferably a RAM-backed filesystem
+SHM_DIR = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+
+#: The number of frames kept in a ring
+RING_SLOTS = 16
+
+#: The maximum number of points stored per frame; further points are dropped
+MAX_POINTS = 256
+
+#: The maximum number of clusters stored per frame; further clusters are dropped
+MAX_CLUSTERS = 64
+
+#: The magic bytes at the start of every ring file
+MAGIC = b'TRKS'
+
+#: The ring file header
+HEADER_DTYPE = np.dtype([
+    ('magic', 'S4'),
+    ('version', '<u2'),
+    ('slots', '<u2'),
+    ('max_points', '<u4'),
+    ('max_clusters', '<u4'),
+    ('latest', '<i8')
+], align = True)
+
+# slots start on a cache line boundary
+SLOTS_OFFSET = 64
+
+
+def slot_dtype(max_points, max_clusters):
+    """
+    :return: the layout of a single ring slot
+    """
+    return np.dtype([
+        ('seq', '<u8'),
+        ('timestamp', '<f8'),
+        ('camera', '<u4'),
+        ('frame_count', '<u4'),
+        ('point_count', '<u4'),
+        ('cluster_count', '<u4'),
+        ('points', POINT_DTYPE, (max_points,)),
+        ('clusters', CLUSTER_DTYPE, (max_clusters,))
+    ], align = True)
+
+
+def ring_path(name, directory = SHM_DIR):
+    return os.path.join(directory, 'tracking-%s.ring' % name)
+
+
+class SharedMemoryWriter:
+    """
+    Writes tracking results into a shared-memory ring. Provides the same ``publish`` method as
+    :class:`tracking.publish.Publisher`, so it can be used in its place.
+    """
+
+    def __init__(self, name, slots = RING_SLOTS, max_points = MAX_POINTS, max_clusters = MAX_CLUSTERS,
+                 directory = SHM_DIR):
+        """
+        :param name: the ring name, which readers open it by
+        :param slots: the number of frames kept in the ring
+        :param max_points: the maximum number of points stored per frame
+        :param max_clusters: the maximum number of clusters stored per frame
+        :param directory: the directory to create the ring file in
+        """
+        self.path = ring_path(name, directory)
+
+        dtype = slot_dtype(max_points, max_clusters)
+        size = SLOTS_OFFSET + slots * dtype.itemsize
+
+        # a new file, so readers of a previous ring keep their (stale) mapping rather than seeing it change layout
+        temp_path = self.path + '.%d' % os.getpid()
+        with open(temp_path, 'wb') as f:
+            f.truncate(size)
+
+        fd = os.open(temp_path, os.O_RDWR)
+        try:
+            self.map = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+
+        self.header = np.frombuffer(self.map, HEADER_DTYPE, 1)[0:1]
+        self.slots = np.frombuffer(self.map, dtype, slots, SLOTS_OFFSET)
+
+        self.header['magic'] = MAGIC
+        self.header['version'] = VERSION
+        self.header['slots'] = slots
+        self.header['max_points'] = max_points
+        self.header['max_clusters'] = max_clusters
+        self.header['latest'] = -1
+
+        os.rename(temp_path, self.path)
+
+        self.sequence = 0
+
+        #: the number of points and clusters dropped because a frame exceeded the slot capacity
+        self.dropped = 0
+
+    def publish(self, camera, frame_count, timestamp, points, clusters):
+        """
+        Writes a frame's results into the next slot. Never blocks.
+
+        :param camera: the camera index
+        :param frame_count: the frame number
+        :param timestamp: the frame's capture time, in seconds
+        :param points: a list of :class:`tracking.point.Point` instances
+        :param clusters: a list of :class:`tracking.cluster.Cluster` instances
+        :return: the sequence number of the written frame
+        """
+        point_array = point_records(points, clusters)
+        cluster_array = cluster_records(clusters)
+
+        n = self.sequence
+        self.sequence += 1
+
+        slot = self.slots[n % len(self.slots):][:1]
+        max_points = slot['points'].shape[1]
+        max_clusters = slot['clusters'].shape[1]
+
+        self.dropped += max(0, len(point_array) - max_points) + max(0, len(cluster_array) - max_clusters)
+        point_array = point_array[:max_points]
+        cluster_array = cluster_array[:max_clusters]
+
+        # odd while being written
+        slot['seq'] = 2 * n + 1
+
+        slot['timestamp'] = timestamp
+        slot['camera'] = camera
+        slot['frame_count'] = frame_count & 0xffffffff
+        slot['point_count'] = len(point_array)
+        slot['cluster_count'] = len(cluster_array)
+        slot['points'][0, :len(point_array)] = point_array
+        slot['clusters'][0, :len(cluster_array)] = cluster_array
+
+        slot['seq'] = 2 * n + 2
+        self.header['latest'] = n
+
+        return n
+
+    def close(self, remove = True):
+        """
+        :param remove: if True, the ring file is removed; readers that already mapped it are unaffected
+        """
+        self.map.close()
+
+        if remove and os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class SharedMemoryReader:
+    """
+    Reads tracking results from a shared-memory ring created by a :class:`SharedMemoryWriter`.
+    """
+
+    def __init__(self, name, directory = SHM_DIR):
+        """
+        :param name: the ring name
+        :param directory: the directory the ring file was created in
+        """
+        path = ring_path(name, directory)
+
+        with open(path, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+
+        header = np.frombuffer(self.map, HEADER_DTYPE, 1)[0]
+        if header['magic'] != MAGIC:
+            raise SchemaError("bad magic: %r" % header['magic'])
+
+        if header['version'] != VERSION:
+            raise SchemaError("unsupported schema version: %d" % header['version'])
+
+        self.header = np.frombuffer(self.map, HEADER_DTYPE, 1)
+        self.slots = np.frombuffer(self.map, slot_dtype(header['max_points'], header['max_clusters']),
+                                   header['slots'], SLOTS_OFFSET)
+
+    @property
+    def latest_sequence(self):
+        """
+        :return: the sequence number of the most recently written frame, or -1 if none has been written
+        """
+        return int(self.header['latest'][0])
+
+    def view(self, n):
+        """
+        Returns the frame with sequence number ``n`` as views directly into shared memory, without copying. The views
+        may be overwritten by the writer at any time: check :meth:`is_valid` after using them.
+
+        :param n: the sequence number
+        :return: a :class:`tracking.schema.Message`, or None if the frame is being written or was already overwritten
+        """
+        slot = self.slots[n % len(self.slots)]
+        if slot['seq'] != 2 * n + 2:
+            return None
+
+        return Message(int(slot['camera']), n, int(slot['frame_count']), float(slot['timestamp']),
+                       slot['points'][:slot['point_count']], slot['clusters'][:slot['cluster_count']])
+
+    def is_valid(self, message):
+        """
+        :param message: a message returned by :meth:`view`
+        :return: True if the message's slot hasn't been written to since it was viewed
+        """
+        n = message.sequence
+
+        return self.slots['seq'][n % len(self.slots)] == 2 * n + 2
+
+    def read(self, camera = None, retries = 10):
+        """
+        Copies the most recent consistent frame out of shared memory.
+
+        :param camera: if set, the most recent frame from this camera index is returned instead
+        :param retries: the number of times to retry if the writer overwrites a frame while it is being read
+        :return: a :class:`tracking.schema.Message` with copied records, or None if no frame is available
+        """
+        for attempt in range(retries):
+            latest = self.latest_sequence
+
+            message = None
+            for n in range(latest, max(-1, latest - len(self.slots)), -1):
+                message = self.view(n)
+                if message is not None and (camera is None or message.camera == camera):
+                    break
+
+                message = None
+
+            if message is None:
+                if latest < 0:
+                    return None
+
+                continue
+
+            copied = message._replace(points = message.points.copy(), clusters = message.clusters.copy())
+            if self.is_valid(message):
+                return copied
+
+        return None
+
+    def close(self):
+        self.map.close()
@@ -0,0 +1,282 @@
+# -*- coding: utf-8 -*-
+"""
+Multi-camera triangulation of cluster centers and points.
+
+Clusters seen by several cameras are matched by color label and the epipolar constraint, then all matched cluster
+centers and member points are triangulated together in one batched linear (DLT) solve, using each camera's stored
+projection matrix.
+
+Correspondence uses an index of clusters by color, built once per camera per frame, so each cluster is only compared
+against same-colored clusters in other views rather than against every cluster of every camera. Since colors are
+intended to be unique per cluster, this is usually a single comparison.
+
+Typical use, with the clusters from one frame of each :class:`tracking.main.TrackingThread`::
+
+    triangulator = Triangulator({'Center': p_center, 'Right': p_right})
+    markers = triangulator.triangulate({'Center': center_clusters, 'Right': right_clusters})
+"""
+
+import numpy as np
+
+from itertools import combinations
+
+#: The maximum (symmetric) distance, in pixels, between a point and its epipolar line in another view for the two to
+#: be considered the same
+EPIPOLAR_THRESHOLD = 4.0
+
+
+class Marker(object):
+    """
+    A cluster triangulated from two or more views.
+    """
+
+    __slots__ = ('color', 'center', 'points', 'views')
+
+    def __init__(self, color, center, points, views):
+        #: the cluster color label
+        self.color = color
+
+        #: the 3D position of the cluster center
+        self.center = center
+
+        #: a list of 3D positions of the cluster's points, where they could be matched
+        self.points = points
+
+        #: a list of (camera name, cluster) tuples this marker was seen in
+        self.views = views
+
+
+def camera_center(projection):
+    """
+    :param projection: a 3x4 projection matrix
+    :return: the camera center in homogeneous coordinates
+    """
+    return np.linalg.svd(projection)[2][-1]
+
+
+def fundamental_matrix(p1, p2):
+    """
+    Computes the fundamental matrix between two views, such that ``x2.T * F * x1 = 0`` for corresponding points.
+
+    :param p1: the first view's 3x4 projection matrix
+    :param p2: the second view's 3x4 projection matrix
+    :return: the 3x3 fundamental matrix
+    """
+    ex, ey, ez = p2.dot(camera_center(p1))
+    epipole_cross = np.array([
+        [0, -ez, ey],
+        [ez, 0, -ex],
+        [-ey, ex, 0]
+    ])
+
+    return epipole_cross.dot(p2).dot(np.linalg.pinv(p1))
+
+
+def epipolar_distances(fundamental, a, b):
+    """
+    Computes symmetric epipolar distances for all pairs of points between two views.
+
+    :param fundamental: the fundamental matrix from view a to view b
+    :param a: an n x 2 array of points in view a
+    :param b: an m x 2 array of points in view b
+    :return: an n x m array of distances, in pixels
+    """
+    ha = np.column_stack((a, np.ones(len(a))))
+    hb = np.column_stack((b, np.ones(len(b))))
+
+    lines_b = ha.dot(fundamental.T)  # epipolar lines in b, n x 3
+    lines_a = hb.dot(fundamental)    # epipolar lines in a, m x 3
+
+    algebraic = np.abs(lines_b.dot(hb.T))  # n x m
+
+    norm_b = np.sqrt((lines_b[:, :2]**2).sum(axis = 1))[:, None]
+    norm_a = np.sqrt((lines_a[:, :2]**2).sum(axis = 1))[None, :]
+
+    return 0.5 * algebraic * (1.0 / np.maximum(norm_b, 1e-12) + 1.0 / np.maximum(norm_a, 1e-12))
+
+
+def match_points(distances, threshold = EPIPOLAR_THRESHOLD):
+    """
+    Greedily pairs rows and columns of a distance matrix in order of increasing distance.
+
+    :param distances: an n x m array of distances
+    :param threshold: the maximum distance of a pair
+    :return: a list of (row, column) pairs
+    """
+    pairs = []
+    if distances.size == 0:
+        return pairs
+
+    used_rows = set()
+    used_columns = set()
+    for index in np.argsort(distances, axis = None):
+        row, column = np.unravel_index(index, distances.shape)
+        if distances[row, column] > threshold:
+            break
+
+        if row in used_rows or column in used_columns:
+            continue
+
+        used_rows.add(row)
+        used_columns.add(column)
+        pairs.append((row, column))
+
+    return pairs
+
+
+def triangulate_batch(projections, observations):
+    """
+    Triangulates many points at once with the linear DLT method. Each point may be seen by a different number of
+    views; missing views are padded with zero rows, which do not affect the solution.
+
+    :param projections: a list of 3x4 projection matrices
+    :param observations: a list (one per point) of lists of (view index, x, y) tuples
+    :return: an n x 3 array of points
+    """
+    if not observations:
+        return np.empty((0, 3))
+
+    max_views = max(len(o) for o in observations)
+    systems = np.zeros((len(observations), 2 * max_views, 4))
+
+    for i, observation in enumerate(observations):
+        for j, (view, x, y) in enumerate(observation):
+            p = projections[view]
+            systems[i, 2 * j] = x * p[2] - p[0]
+            systems[i, 2 * j + 1] = y * p[2] - p[1]
+
+    # the solution of each system is its right singular vector with the smallest singular value
+    solutions = np.linalg.svd(systems)[2][:, -1, :]
+
+    return solutions[:, :3] / solutions[:, 3:]
+
+
+class Triangulator:
+    """
+    Matches and triangulates clusters across a fixed set of calibrated cameras. Fundamental matrices for every pair of
+    cameras are precomputed from the stored projection matrices.
+    """
+
+    def __init__(self, projections, threshold = EPIPOLAR_THRESHOLD):
+        """
+        :param projections: a dict of camera name to 3x4 projection matrix
+        :param threshold: see :data:`.EPIPOLAR_THRESHOLD`
+        """
+        self.names = sorted(projections)
+        self.projections = [np.asarray(projections[name], dtype = float) for name in self.names]
+        self.threshold = threshold
+
+        self.fundamentals = {}
+        for i, j in combinations(range(len(self.names)), 2):
+            self.fundamentals[i, j] = fundamental_matrix(self.projections[i], self.projections[j])
+
+    def index(self, clusters):
+        """
+        Builds the per-frame correspondence index for a single camera.
+
+        :param clusters: the camera's clusters
+        :return: a dict of color label to (list of clusters, k x 2 array of centers)
+        """
+        buckets = {}
+        for cluster in clusters:
+            color = cluster.color
+            if color is not None:
+                buckets.setdefault(color, []).append(cluster)
+
+        return dict((color, (members, np.array([(c.center.x, c.center.y) for c in members], dtype = float)))
+                    for color, members in buckets.iteritems())
+
+    def match(self, indexes):
+        """
+        Groups clusters seen by several cameras, using the color index and the epipolar constraint between each pair
+        of cameras. Matches are merged transitively, so a group may span any number of cameras.
+
+        :param indexes: a list of per-camera indexes, as returned by :meth:`index`
+        :return: a list of groups, each a (color, list of (camera index, cluster)) tuple
+        """
+        # union-find over (camera index, cluster) nodes
+        parents = {}
+
+        def find(node):
+            while parents.get(node, node) != node:
+                node = parents[node]
+
+            return node
+
+        for (i, j), fundamental in self.fundamentals.iteritems():
+            for color, (a_clusters, a_centers) in indexes[i].iteritems():
+                if color not in indexes[j]:
+                    continue
+
+                b_clusters, b_centers = indexes[j][color]
+
+                distances = epipolar_distances(fundamental, a_centers, b_centers)
+                for row, column in match_points(distances, self.threshold):
+                    a = find((i, a_clusters[row]))
+                    b = find((j, b_clusters[column]))
+                    if a != b:
+                        parents[b] = a
+
+        groups = {}
+        for node in parents.keys() + parents.values():
+            groups.setdefault(find(node), set()).add(node)
+
+        results = []
+        for root, nodes in groups.iteritems():
+            views = sorted(nodes, key = lambda node: node[0])
+
+            # only one cluster per camera; skip ambiguous groups
+            if len(set(view for view, cluster in views)) != len(views):
+                continue
+
+            results.append((root[1].color, views))
+
+        return results
+
+    def triangulate(self, clusters):
+        """
+        Matches and triangulates the clusters of a single time slot.
+
+        :param clusters: a dict of camera name to the camera's clusters
+        :return: a list of :class:`Marker` instances
+        """
+        indexes = [self.index(clusters.get(name, [])) for name in self.names]
+        groups = self.match(indexes)
+
+        # gather every center and matched point observation into one batch
+        observations = []
+        layout = []
+        for color, views in groups:
+            center = len(observations)
+            observations.append([(view, c.center.x, c.center.y) for view, c in views])
+
+            # match member points against the first view of the group
+            reference_view, reference = views[0]
+            reference_points = list(reference.points)
+            reference_xy = np.array([(p.x, p.y) for p in reference_points], dtype = float)
+
+            point_observations = [[(reference_view, p.x, p.y)] for p in reference_points]
+            for view, cluster in views[1:]:
+                points = list(cluster.points)
+                xy = np.array([(p.x, p.y) for p in points], dtype = float)
+
+                distances = epipolar_distances(self.fundamentals[reference_view, view], reference_xy, xy)
+                for row, column in match_points(distances, self.threshold):
+                    point_observations[row].append((view, points[column].x, points[column].y))
+
+            # points follow their cluster's center in the batch
+            point_observations = [o for o in point_observations if len(o) >= 2]
+            observations.extend(point_observations)
+
+            layout.append((color, views, center, len(point_observations)))
+
+        positions = triangulate_batch(self.projections, observations)
+
+        markers = []
+        for color, views, center, count in layout:
+            points = list(positions[center + 1:center + 1 + count])
+            views = [(self.names[view], cluster) for view, cluster in views]
+
+            markers.append(Marker(color, positions[center], points, views))
+
+        return markers
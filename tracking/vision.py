@@ -12,15 +12,35 @@ import numpy as np
 from point import Point, SimplePoint
 from color import bgr_to_hsv
 
+#: If True, :class:`Circle` instances retain their full contour; by default the contour is dropped once features have
+#: been extracted, as :class:`tracking.point.Point` keeps a history of circles
+KEEP_CONTOURS = False
+
+#: The number of erosion iterations used to find dark search areas, see :func:`find_search_area`
+EROSION_ITERATIONS = 15
+
+#: The minimum contour area, in pixels, of a candidate circle
+MIN_AREA = 30
+
+#: The maximum contour area, in pixels, of a candidate circle
+MAX_AREA = 700
+
 kernel = np.ones((3, 3), np.uint8)
 pi4 = np.pi * 4
 
 
-class Circle:
+class Circle(object):
     """
     A raw candidate point. These can be passed to the point tracking algorithm :mod:`tracking.point`.
+
+    Circles are created for every candidate contour in every frame, so they use ``__slots__`` to stay compact.
+
+    Coordinates are in (distorted) image space until undistorted by :meth:`tracking.calibration.Calibration.undistort_circles`,
+    which keeps the original image position in ``raw``.
     """
 
+    __slots__ = ('frame', 'contour', 'color', 'x', 'y', 'radius', 'circularity', 'raw')
+
     def __init__(self, frame, contour, color, x, y, radius, circularity):
         self.frame = frame
         self.contour = contour
@@ -30,52 +50,169 @@ class Circle:
         self.radius = radius
         self.circularity = circularity
 
+        # the (x, y) image position, if x and y have since been undistorted
+        self.raw = None
+
     @property
     def pos(self):
         return int(self.x), int(self.y)
 
+    @classmethod
+    def from_point(cls, point, frame, x, y):
+        """
+        Creates a synthetic circle for a known point at a new position, e.g. when a point is tracked by some means
+        other than detection. Color, radius and circularity are carried over from the point's history.
+
+        :param point: a :class:`tracking.point.Point` instance
+        :param frame: the current frame number
+        :param x: the new x coordinate, in image space (see :attr:`tracking.point.Point.raw_pos`)
+        :param y: the new y coordinate, in image space
+        :return: a Circle instance
+        """
+        last = point.circle_history[-1]
+
+        return cls(frame, None, last.color, x, y, last.radius, point.circularity_mean)
 
-def preprocess(frame):
+    def copy(self, frame):
+        """
+        :param frame: the frame number of the copy
+        :return: a copy of this circle, as seen in another frame
+        """
+        circle = Circle(frame, self.contour, self.color, self.x, self.y, self.radius, self.circularity)
+        circle.raw = self.raw
+
+        return circle
+
+
+class FrameBuffers:
+    """
+    A per-thread arena of preallocated images for the vision stages. Buffers are sized on the first frame (and
+    reallocated only if the frame size changes), and are passed as OpenCV ``dst`` arguments so that steady-state
+    processing does not allocate any images.
+
+    Preprocessed frames are handed to other threads via :attr:`tracking.main.TrackingThread.frames`, so they are
+    rotated through a small ring: one frame being written, one waiting in the queue, and one held by the consumer.
+    """
+
+    def __init__(self, outputs = 3):
+        self.output_count = outputs
+        self.output_index = 0
+        self.shape = None
+
+        self.tiles = {}
+
+    def ensure(self, frame):
+        """
+        Allocates buffers to match the given frame, if necessary.
+
+        :param frame: a BGR frame
+        """
+        if frame.shape == self.shape:
+            return
+
+        self.shape = frame.shape
+        height, width, _ = frame.shape
+
+        self.outputs = [np.empty_like(frame) for i in range(self.output_count)]
+        self.eroded = np.empty_like(frame)
+        self.all_black = np.empty((height, width), np.uint8)
+        self.gray = np.empty((height, width), np.uint8)
+        self.edges = np.empty((height, width), np.uint8)
+        self.mask = np.empty((height, width), np.uint8)
+
+    def next_output(self):
+        """
+        :return: the next preprocessed frame buffer in the ring
+        """
+        self.output_index = (self.output_index + 1) % self.output_count
+
+        return self.outputs[self.output_index]
+
+    def tile(self, index):
+        """
+        Returns a child arena for a single tile of a frame, e.g. for
+        :class:`tracking.detector.TiledContourDetector`. Tile outputs are consumed immediately, so no ring is needed.
+
+        :param index: the tile index
+        :return: a :class:`FrameBuffers` instance
+        """
+        if index not in self.tiles:
+            self.tiles[index] = FrameBuffers(outputs = 1)
+
+        return self.tiles[index]
+
+
+def _buffer(buffers, frame, name):
+    """
+    Fetches a named buffer for the given frame, or None (letting OpenCV allocate) if no arena is in use.
+    """
+    if buffers is None:
+        return None
+
+    buffers.ensure(frame)
+
+    return getattr(buffers, name)
+
+
+def preprocess(frame, buffers = None):
     """
     Preprocesses the given frame. Currently this only applies a Gaussian blur to eliminate some noise.
 
     :param frame: the frame to process
+    :param buffers: an optional :class:`FrameBuffers` arena
     :return: the processed frame
     """
-    return cv2.GaussianBlur(frame, (5, 5), 2)
+    dst = None
+    if buffers is not None:
+        buffers.ensure(frame)
+        dst = buffers.next_output()
+
+    return cv2.GaussianBlur(frame, (5, 5), 2, dst = dst)
 
 
-def find_edges(frame):
+def find_search_area(frame, buffers = None, erosion = EROSION_ITERATIONS):
     """
-    Finds edges in a raw or preprocessed color image. A mask will be applied to
-    filter for only (largely) dark areas.
+    Masks a raw or preprocessed color image to only (largely) dark areas, where points may be found.
 
     :param frame: the raw or preprocessed BGR frame
-    :return: the frame with Canny edge detection applied to regions of interest
+    :param buffers: an optional :class:`FrameBuffers` arena
+    :param erosion: the number of erosion iterations; fewer is cheaper, but leaves more of the frame to search
+    :return: a grayscale image of the search area, zero outside of it
     """
 
     # find black areas + erode, dilate to eliminate dots
-    eroded = cv2.erode(frame, kernel, iterations = 15)
+    eroded = cv2.erode(frame, kernel, dst = _buffer(buffers, frame, 'eroded'), iterations = erosion)
 
     # erosion here would reduce a lot of invalid search area, but it's
     # expensive and the point tracking is robust enough that it isn't necessary
     #eroded = cv2.dilate(eroded, kernel, iterations = 20)
 
-    ret, black = cv2.threshold(eroded, 60, 255, cv2.THRESH_BINARY_INV)
+    # single binary image of areas where every channel is below the threshold
+    # (equivalent to an inverse binary threshold on each channel, ANDed together)
+    all_black = cv2.inRange(eroded, (0, 0, 0), (60, 60, 60), _buffer(buffers, frame, 'all_black'))
 
-    # merge into single binary image to use as mask
-    bb, bg, br = cv2.split(black)
-    all_black = cv2.bitwise_and(br, bg)
-    all_black = cv2.bitwise_and(all_black, bb)
-    search_area = cv2.bitwise_and(frame, frame, mask = all_black)
+    # convert to grayscale and apply the mask to use for edge detection
+    black_region = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY, dst = _buffer(buffers, frame, 'gray'))
 
-    # convert to grayscale to use for edge detection
-    black_region = cv2.cvtColor(search_area, cv2.COLOR_BGR2GRAY)
+    return cv2.bitwise_and(black_region, all_black, dst = black_region)
 
-    return cv2.Canny(black_region, 100, 50)
+
+def find_edges(frame, buffers = None, erosion = EROSION_ITERATIONS):
+    """
+    Finds edges in a raw or preprocessed color image. A mask will be applied to
+    filter for only (largely) dark areas; see :func:`find_search_area`.
+
+    :param frame: the raw or preprocessed BGR frame
+    :param buffers: an optional :class:`FrameBuffers` arena
+    :param erosion: the number of erosion iterations used for the search area
+    :return: the frame with Canny edge detection applied to regions of interest
+    """
+    black_region = find_search_area(frame, buffers, erosion)
+
+    return cv2.Canny(black_region, 100, 50, edges = _buffer(buffers, frame, 'edges'))
 
 
-def find_circles(frame, frame_count, edges):
+def find_circles(frame, frame_count, edges, buffers = None, min_area = MIN_AREA, max_area = MAX_AREA):
     """
     Given an edge-detected frame, locates contour candidates and returns a list
     of Circle instances.
@@ -83,6 +220,9 @@ def find_circles(frame, frame_count, edges):
     :param frame: the original (or preprocessed) frame
     :param frame_count: the current frame number
     :param edges: the edge detected
+    :param buffers: an optional :class:`FrameBuffers` arena
+    :param min_area: the minimum contour area, in pixels
+    :param max_area: the maximum contour area, in pixels
     :return: a list of located Circle instances.
     """
     circles = []
@@ -90,7 +230,7 @@ def find_circles(frame, frame_count, edges):
     cimg, contours, hierarchy = cv2.findContours(edges, cv2.RETR_LIST, cv2.CHAIN_APPROX_NONE)
     for contour in contours:
         area = cv2.contourArea(contour)
-        if area < 30 or area > 700:
+        if area < min_area or area > max_area:
             continue
 
         _, (w, h), angle = cv2.minAreaRect(contour)
@@ -110,16 +250,92 @@ def find_circles(frame, frame_count, edges):
         if circularity < 0.60:
             continue
 
-        # create a mask for the contour area
-        height, width, _ = frame.shape
-        mask = np.zeros((height, width, 1), np.uint8)
-        cv2.drawContours(mask, [contour], 0, 255, -1)
+        # create a mask for the contour area, limited to its bounding rect
+        rx, ry, rw, rh = cv2.boundingRect(contour)
+
+        mask = _buffer(buffers, frame, 'mask')
+        if mask is None:
+            mask = np.zeros((rh, rw), np.uint8)
+        else:
+            # a contiguous view over the start of the scratch buffer, so OpenCV draws into it directly
+            mask = mask.reshape(-1)[:rh * rw].reshape(rh, rw)
+            mask.fill(0)
+
+        cv2.drawContours(mask, [contour], 0, 255, -1, offset = (-rx, -ry))
 
         # find the mean color within the mask
-        b, g, r, _ = cv2.mean(frame, mask = mask)
+        b, g, r, _ = cv2.mean(frame[ry:ry + rh, rx:rx + rw], mask = mask)
         hsv = bgr_to_hsv((b, g, r))
 
+        if not KEEP_CONTOURS:
+            contour = None
+
         circles.append(Circle(frame_count, contour, hsv, x, y, radius, circularity))
 
     return circles
 
+
+def offset_circles(circles, dx, dy):
+    """
+    Translates circles found in a sub-region of a frame into full frame coordinates. The circles are modified in place.
+
+    :param circles: a list of Circle instances
+    :param dx: the x offset of the sub-region
+    :param dy: the y offset of the sub-region
+    :return: the list of circles
+    """
+    for circle in circles:
+        circle.x += dx
+        circle.y += dy
+
+        if circle.contour is not None:
+            circle.contour += (dx, dy)
+
+    return circles
+
+
+def scale_circles(circles, factor):
+    """
+    Scales circles found in a resized frame back into full frame coordinates. The circles are modified in place.
+
+    :param circles: a list of Circle instances
+    :param factor: the ratio of full frame size to resized frame size
+    :return: the list of circles
+    """
+    for circle in circles:
+        circle.x *= factor
+        circle.y *= factor
+        circle.radius *= factor
+
+        if circle.contour is not None:
+            circle.contour = (circle.contour * factor).astype(circle.contour.dtype)
+
+    return circles
+
+
+def circle_color(frame, x, y, radius):
+    """
+    Finds the mean color of a circular area of a frame, for detectors that do not produce a contour.
+
+    :param frame: the original (or preprocessed) frame
+    :param x: the x coordinate of the circle center
+    :param y: the y coordinate of the circle center
+    :param radius: the circle radius
+    :return: the mean color as an (h, s, v) tuple
+    """
+    height, width, _ = frame.shape
+    size = int(np.ceil(radius))
+
+    x0, y0 = max(int(x) - size, 0), max(int(y) - size, 0)
+    x1, y1 = min(int(x) + size + 1, width), min(int(y) + size + 1, height)
+    if x1 <= x0 or y1 <= y0:
+        return 0, 0, 0
+
+    # only mask the bounding square of the circle rather than the full frame
+    mask = np.zeros((y1 - y0, x1 - x0, 1), np.uint8)
+    cv2.circle(mask, (int(x) - x0, int(y) - y0), size, 255, -1)
+
+    b, g, r, _ = cv2.mean(frame[y0:y1, x0:x1], mask = mask)
+
+    return bgr_to_hsv((b, g, r))
+